@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# ベンチマーク用の Npp モジュールの代わり(Notepad++の外で tagAutoComplete.py を動かすためのもの)
+#   - エディタの内容はUTF-8のバイト列として保持します(PythonScriptと同じく位置はバイト単位)
+#   - オートコンプリートはScintillaの動作(表示位置から選択位置までを置き換える)を簡易的に再現します
+#     - 表示後に入力した文字で候補を絞り込み、その文字で始まる候補がない時はメニューを閉じます(autoHide)
+#     - 表示位置以前まで削除した時もメニューを閉じます(cancelAtStartPos)
+
+import re
+import sys
+
+
+class SCINTILLANOTIFICATION(object):
+    CHARADDED = 'CHARADDED'
+    AUTOCSELECTION = 'AUTOCSELECTION'
+
+
+class NOTIFICATION(object):
+    BUFFERACTIVATED = 'BUFFERACTIVATED'
+    FILESAVED = 'FILESAVED'
+
+
+class Editor(object):
+    """
+    editor オブジェクトの代わり
+    """
+    WORD_CHARS = re.compile(r'[\w/\-]')  # Notepad++で / と - を単語の一部として登録した状態
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self):
+        self.callbacks = {}
+        self.reset()
+
+    # ----------------------------------------------------------------------------------------
+    def reset(self):
+        """
+        エディタの内容とオートコンプリートの状態を初期化する
+        """
+        self.text = ''
+        self.pos = 0
+        self.separator = 32
+        self.ac_active = False
+        self.ac_pos_start = 0
+        self.ac_items = []
+        self.show_count = 0
+
+    # ----------------------------------------------------------------------------------------
+    def is_word_char(self, c):
+        return c >= '\x80' or self.WORD_CHARS.match(c) is not None  # マルチバイト文字も単語の一部として扱う
+
+    # ----------------------------------------------------------------------------------------
+    def type_char(self, c):
+        """
+        文字を入力する(CHARADDEDの通知は呼び出し側で行なう)
+        c: 入力する文字(UTF-8のバイト列)
+        """
+        self.text = self.text[:self.pos] + c + self.text[self.pos:]
+        self.pos += len(c)
+        if self.ac_active:
+            self.ac_filter()
+
+    # ----------------------------------------------------------------------------------------
+    def backspace(self):
+        """
+        カーソルの前の1文字を削除する
+        """
+        if self.pos == 0:
+            return
+        start = self.pos - 1
+        while start > 0 and '\x80' <= self.text[start] < '\xc0':  # UTF-8の継続バイトを飛ばす
+            start -= 1
+        self.text = self.text[:start] + self.text[self.pos:]
+        self.pos = start
+        if self.ac_active:
+            if self.pos <= self.ac_pos_start:
+                self.ac_active = False
+            else:
+                self.ac_filter()
+
+    # ----------------------------------------------------------------------------------------
+    def ac_filter(self):
+        """
+        メニューの表示位置からカーソル位置までの文字列で候補を絞り込み、その文字列で始まる候補がない時はメニューを閉じる
+        (Scintillaの標準の設定と同じく、大文字と小文字を区別する)
+        """
+        if self.pos < self.ac_pos_start:
+            self.ac_active = False
+            return
+        entered = self.text[self.ac_pos_start:self.pos]
+        for item in self.ac_items:
+            if (item if isinstance(item, str) else item.encode('utf-8')).startswith(entered):
+                return
+        self.ac_active = False
+
+    # ----------------------------------------------------------------------------------------
+    def select_item(self, index):
+        """
+        オートコンプリートの候補を選択して挿入する(AUTOCSELECTIONの通知は呼び出し側で行なう)
+        index: 選択する候補の番号
+        戻り値: 選択した候補(UTF-8のバイト列)。メニューが表示されていない時はNone
+        """
+        if not self.ac_active or index >= len(self.ac_items):
+            return None
+        item = self.ac_items[index]
+        if not isinstance(item, str):
+            item = item.encode('utf-8')
+        self.text = self.text[:self.ac_pos_start] + item + self.text[self.pos:]
+        self.pos = self.ac_pos_start + len(item)
+        self.ac_active = False
+        return item
+
+    # ----------------------------------------------------------------------------------------
+    def callback(self, func, events):
+        for ev in events:
+            self.callbacks.setdefault(ev, []).append(func)
+
+    def clearCallbacks(self, events=None):
+        for ev in (events if events is not None else list(self.callbacks)):
+            self.callbacks.pop(ev, None)
+
+    def getCurrentPos(self):
+        return self.pos
+
+    def getLength(self):
+        return len(self.text)
+
+    def getWord(self, pos, onlyWordCharacters=True):
+        start = pos
+        while start > 0 and self.is_word_char(self.text[start-1]):
+            start -= 1
+        end = pos
+        while end < len(self.text) and self.is_word_char(self.text[end]):
+            end += 1
+        return self.text[start:end]
+
+    def getTextRange(self, start, end):
+        return self.text[start:end]
+
+    def setTargetRange(self, start, end):
+        self.target = (start, end)
+
+    def replaceTarget(self, text):
+        if not isinstance(text, str):
+            text = text.encode('utf-8')
+        start, end = self.target
+        self.text = self.text[:start] + text + self.text[end:]
+        return len(text)
+
+    def gotoPos(self, pos):
+        self.pos = pos
+
+    def autoCGetSeparator(self):
+        return self.separator
+
+    def autoCSetSeparator(self, separator):
+        self.separator = separator
+
+    def autoCShow(self, len_entered, item_list):
+        self.ac_items = item_list.split(unichr(self.separator) if isinstance(item_list, unicode) else chr(self.separator))
+        self.ac_active = True
+        self.ac_pos_start = self.pos - len_entered
+        self.show_count += 1
+
+    def autoCActive(self):
+        return self.ac_active
+
+    def autoCPosStart(self):
+        return self.ac_pos_start
+
+    def autoCCancel(self):
+        self.ac_active = False
+
+
+class Notepad(object):
+    """
+    notepad オブジェクトの代わり
+    """
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self):
+        self.callbacks = {}
+        self.filename = 'prompt.txt'
+
+    def callback(self, func, events):
+        for ev in events:
+            self.callbacks.setdefault(ev, []).append(func)
+
+    def clearCallbacks(self, events=None):
+        for ev in (events if events is not None else list(self.callbacks)):
+            self.callbacks.pop(ev, None)
+
+    def getCurrentFilename(self):
+        return self.filename
+
+
+class Console(object):
+    """
+    console オブジェクトの代わり(出力を保持し、verboseがTrueの時は標準エラー出力にも書き込む)
+    """
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self):
+        self.lines = []
+        self.verbose = False
+
+    def write(self, s):
+        self.lines.append(s)
+        if self.verbose:
+            sys.stderr.write(s if isinstance(s, str) else s.encode('utf-8'))
+
+
+editor = Editor()
+notepad = Notepad()
+console = Console()
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+# tagAutoComplete.py のベンチマーク(Notepad++の外で実行します)
+#
+# 使い方
+#   PythonScriptと同じPython 2.7で実行してください
+#     python bench/bench_tagautocomplete.py
+#     python bench/bench_tagautocomplete.py --rows 10000,100000,1000000 --configs partial,prefix
+#     python bench/bench_tagautocomplete.py --save-session session.json   (入力の記録を保存する)
+#     python bench/bench_tagautocomplete.py --session session.json        (保存した入力を再生する)
+#     python bench/bench_tagautocomplete.py --verify --rows 5000          (検索結果を全件を調べた結果と比べる)
+#   合成したタグファイル(CSV)、ワイルドカード、Loraのディレクトリを一時フォルダに作成し、
+#   設定(CONFIGS)ごとに別プロセスでスクリプトを起動して次の値を計測します
+#     - 起動時間(キャッシュなし / キャッシュあり)と、タグ、ワイルドカード、Loraそれぞれの読み込み時間
+#     - 1文字入力するごとの遅延(on_char_added から補完メニューの表示まで)のp50/p95/p99
+#     - 候補選択時(on_autocompletion_selected)の処理時間のp50/p95/p99
+#     - 最大メモリ使用量(resourceモジュールが使えない環境では表示しません)
+
+from __future__ import print_function
+
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 計測する設定(tagAutoComplete.py の設定項目を上書きする)
+CONFIGS = [
+    ('partial', {'OPT_WORD_IN': True}),
+    ('partial-scan', {'OPT_WORD_IN': True, 'NGRAM_INDEX_MAX_MB': 0}),
+    ('prefix', {'OPT_WORD_IN': False}),
+    ('ranked', {'OPT_WORD_IN': True, 'RANK_BY_COUNT': True}),
+    ('fuzzy', {'OPT_WORD_IN': True, 'FUZZY_MAX_DISTANCE': 1}),
+    ('fuzzy2', {'OPT_WORD_IN': True, 'FUZZY_MAX_DISTANCE': 2}),
+    ('no-alias', {'OPT_WORD_IN': True, 'USE_TAG_ALIAS': False}),
+    ('no-history', {'OPT_WORD_IN': True, 'USE_HISTORY': False}),
+    ('profile', {'OPT_WORD_IN': True, 'PROFILE_MODE': True}),  # 計測の負荷の確認用(--verbose で計測結果を表示する)
+]
+
+# --verify で確認する設定(入力の記録を1文字ずつ再生し、前回の検索結果を絞り込んだ結果を全件を調べた結果と比べる)
+VERIFY_CONFIGS = [
+    ('partial', {'OPT_WORD_IN': True}),
+    ('partial-scan', {'OPT_WORD_IN': True, 'NGRAM_INDEX_MAX_MB': 0}),
+    ('prefix', {'OPT_WORD_IN': False}),
+    ('ranked', {'OPT_WORD_IN': True, 'RANK_BY_COUNT': True}),
+    ('ranked-scan', {'OPT_WORD_IN': True, 'RANK_BY_COUNT': True, 'NGRAM_INDEX_MAX_MB': 0}),
+    ('ranked-equal', {'OPT_WORD_IN': True, 'RANK_BY_COUNT': True, 'PARTIAL_MATCH_WEIGHT': 1.0}),
+    ('ranked-inverted', {'OPT_WORD_IN': True, 'RANK_BY_COUNT': True, 'PARTIAL_MATCH_WEIGHT': 4.0}),  # 部分一致の重みの方が大きい
+    ('fuzzy', {'OPT_WORD_IN': True, 'FUZZY_MAX_DISTANCE': 1}),
+    ('fuzzy2', {'OPT_WORD_IN': True, 'FUZZY_MAX_DISTANCE': 2}),
+    ('fuzzy-prefix', {'OPT_WORD_IN': False, 'FUZZY_MAX_DISTANCE': 1}),
+]
+
+SYLLABLES = ['ka', 'shi', 'ro', 'lo', 'ng', 'ha', 'ir', 'bl', 'ue', 'sk', 'y', 'smi', 'le', 'ope', 'n', 'mo',
+             'uth', 'ey', 'es', 'ba', 'ck', 'gr', 'ou', 'nd', 'dr', 'ess', 'sh', 'ort', 'ta', 'il', 'wh', 'it']
+
+
+# ----------------------------------------------------------------------------------------
+def make_words(rnd, num):
+    """
+    タグの材料になる単語を作成する
+    """
+    words = set()
+    while len(words) < num:
+        words.add(''.join([rnd.choice(SYLLABLES) for _ in range(rnd.randint(1, 4))]))
+    return sorted(words)
+
+
+# ----------------------------------------------------------------------------------------
+def make_tagfile(path, rows, seed):
+    """
+    合成したタグファイル(A1111形式: タグ,種類,投稿数,"別名,別名")を作成する
+    投稿数は順位に対してべき乗則で減らし、ファイル内の順番は部分的に入れ替える(人気順に並んでいない状態)
+    """
+    rnd = random.Random(seed)
+    words = make_words(rnd, max(200, int(rows ** 0.5) * 4))
+    tags = set()
+    while len(tags) < rows:
+        tags.add('_'.join([rnd.choice(words) for _ in range(rnd.choice([1, 1, 2, 2, 2, 3, 4]))]))
+    tags = sorted(tags)
+    rnd.shuffle(tags)
+    counts = [int(5000000 / (i + 1) ** 0.9) for i in range(rows)]
+    order = list(range(rows))
+    for i in range(rows):  # 近い順位同士を入れ替えて、ファイルの順番と人気順をずらす
+        j = min(rows - 1, i + rnd.randint(0, 50))
+        order[i], order[j] = order[j], order[i]
+
+    with open(path, 'wb') as f:
+        for i, tag in enumerate(tags):
+            aliases = []
+            if rnd.random() < 0.3:
+                aliases = ['_'.join([rnd.choice(words) for _ in range(rnd.randint(1, 2))]) for _ in range(rnd.randint(1, 3))]
+            f.write('{},{},{},"{}"\n'.format(tag, rnd.randint(0, 5), counts[order[i]], ','.join(aliases)))
+    return tags
+
+
+# ----------------------------------------------------------------------------------------
+def make_tree(root, num, ext, seed, header=None):
+    """
+    合成したワイルドカード、Loraのディレクトリを作成する
+    header: ファイルの内容を作成する関数(Noneの時は空のファイル)
+    """
+    rnd = random.Random(seed)
+    words = make_words(rnd, 300)
+    dirs = ['']
+    for _ in range(max(1, num // 20)):
+        dirs.append(os.path.join(rnd.choice(dirs), rnd.choice(words)))
+    names = []
+    for i in range(num):
+        d = os.path.join(root, rnd.choice(dirs))
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        name = '{}_{}'.format('_'.join([rnd.choice(words) for _ in range(rnd.randint(1, 3))]), i)
+        with open(os.path.join(d, name + ext), 'wb') as f:
+            if header is not None:
+                f.write(header(rnd, words))
+        names.append(name)
+    return names
+
+
+# ----------------------------------------------------------------------------------------
+def safetensors_header(rnd, words):
+    """
+    学習時のメタデータだけを持つsafetensorsファイルの内容を作成する
+    """
+    freq = dict([('_'.join([rnd.choice(words) for _ in range(2)]), rnd.randint(1, 100)) for _ in range(rnd.randint(3, 30))])
+    metadata = {'__metadata__': {'ss_tag_frequency': json.dumps({'10_dataset': freq}), 'ss_output_name': rnd.choice(words)}}
+    header = json.dumps(metadata)
+    return struct.pack('<Q', len(header)) + header + '\0' * 64
+
+
+# ----------------------------------------------------------------------------------------
+def make_session(tags, wildcards, loras, num_words, seed):
+    """
+    合成した入力の記録を作成する
+    入力イベント: ['key', 文字], ['backspace'], ['select', 候補の番号]
+    """
+    rnd = random.Random(seed)
+    events = []
+    for _ in range(num_words):
+        kind = rnd.random()
+        if kind < 0.1 and wildcards:
+            prefix, word = '__', rnd.choice(wildcards)
+        elif kind < 0.2 and loras:
+            prefix, word = '____', rnd.choice(loras)
+        else:
+            prefix, word = '', rnd.choice(tags[:max(1, len(tags) // 10)] if rnd.random() < 0.7 else tags)
+        start = rnd.randint(0, max(0, len(word) // 2)) if rnd.random() < 0.3 else 0  # 単語の途中から入力(部分一致)
+        typed = prefix + word[start:start + rnd.randint(2, max(2, min(12, len(word) - start)))]
+        for i, c in enumerate(typed):
+            events.append(['key', c])
+            if rnd.random() < 0.05 and i > 0:  # 入力ミスと修正
+                events.append(['key', rnd.choice('abcdefghijklmnopqrstuvwxyz')])
+                events.append(['backspace'])
+        if rnd.random() < 0.8:
+            events.append(['select', 0])
+        else:
+            events.append(['key', ','])
+            events.append(['key', ' '])
+    return events
+
+
+# ----------------------------------------------------------------------------------------
+def percentile(values, p):
+    """
+    パーセンタイル値を返す(最近傍法)
+    """
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+
+# ----------------------------------------------------------------------------------------
+def peak_memory_mb():
+    """
+    プロセスの最大メモリ使用量(MB)を返す(取得できない場合はNone)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1.0)  # macOSはバイト、Linuxはキロバイト
+
+
+# ----------------------------------------------------------------------------------------
+def wait_until(cond, timeout=600.0):
+    """
+    条件を満たすまで待ち、待った時間を返す(タイムアウト時はNone)
+    """
+    start = time.time()
+    while not cond():
+        if time.time() - start > timeout:
+            return None
+        time.sleep(0.001)
+    return time.time() - start
+
+
+# ----------------------------------------------------------------------------------------
+def session_queries(events):
+    """
+    入力の記録を再生して、1文字入力(削除)するごとの入力中の単語の一覧を返す
+    """
+    queries = []
+    word = ''
+    for ev in events:
+        if ev[0] == 'key':
+            word = '' if ev[1] in ', ' else word + ev[1]
+        elif ev[0] == 'backspace':
+            word = word[:-1]
+        else:
+            word = ''
+        if word:
+            queries.append(word.encode('utf-8'))
+    return queries
+
+
+# ----------------------------------------------------------------------------------------
+def expected_suggestions(tac_module, data, lowers, ss, max_num, word_in, use_fuzzy=True):
+    """
+    全件を調べて、タグの補完候補一覧の正解を返す
+    lowers: 小文字化したタグのリスト(順位の順番)
+    use_fuzzy: Falseの時はあいまい検索の候補を追加しない
+    """
+    if word_in:
+        ranks = [r for r, w in enumerate(lowers) if ss in w]
+    else:
+        ranks = [r for r, w in enumerate(lowers) if w.startswith(ss)]
+    if data.counts is not None and word_in:
+        # 重みを掛けた投稿数の多い順(同じ場合は順位の順)
+        weight = lambda r: tac_module.PREFIX_MATCH_WEIGHT if lowers[r].startswith(ss) else tac_module.PARTIAL_MATCH_WEIGHT
+        ranks.sort(key=lambda r: (-(data.counts[r] * weight(r)), r))
+    ranks = ranks[:max_num]
+
+    # 足りない分は、先頭部分との編集距離が FUZZY_MAX_DISTANCE 以下の候補を順位の順に追加する
+    fuzzy = data.fuzzy_index
+    if use_fuzzy and len(ranks) < max_num and fuzzy is not None and len(ss) >= fuzzy.prefix_len:
+        exact = set(ranks)
+        for r, w in enumerate(lowers):
+            if r not in exact and fuzzy.prefix_distance(ss, w, fuzzy.max_distance) <= fuzzy.max_distance:
+                ranks.append(r)
+                if len(ranks) >= max_num:
+                    break
+    return ranks
+
+
+# ----------------------------------------------------------------------------------------
+def run_verify(tagfile, queries, names):
+    """
+    設定ごとにタグの補完候補一覧を全件を調べた結果と比べ、一致しなかった数を返す
+    あいまい検索は1回の入力で確認する候補の数に上限があるため、完全一致の候補の後に正解の先頭部分が並んでいれば一致とする
+    (上限のために足りなかった回数は short に表示する)
+    """
+    sys.path.insert(0, BENCH_DIR)  # ベンチマーク用の Npp モジュールを使う
+    sys.path.insert(1, os.path.dirname(BENCH_DIR))
+    import tagAutoComplete as tac_module
+
+    defaults = dict([(name, getattr(tac_module, name)) for name in ('OPT_WORD_IN', 'RANK_BY_COUNT', 'NGRAM_INDEX_MAX_MB', 'PREFIX_MATCH_WEIGHT', 'PARTIAL_MATCH_WEIGHT', 'FUZZY_MAX_DISTANCE')])
+    configs = dict(VERIFY_CONFIGS)
+    failures = 0
+    for name in names:
+        settings = dict(defaults, USE_TAG_CACHE=False, USE_TAG_ALIAS=False)
+        settings.update(configs[name])
+        for key, value in settings.items():
+            setattr(tac_module, key, value)
+        tm = tac_module.TagManager()
+        tm.load_tagfile([tagfile])
+        data = tm.data
+        lowers = [data.store.get(r).lower() for r in range(len(data))]
+        max_num = tac_module.MAX_SHOW_WORDS
+        mismatches = 0
+        short = 0
+        for q in queries:
+            ss = q.decode('utf-8').lower()
+            got = tm.tag_suggest(q, max_num, tac_module.OPT_WORD_IN)
+            ranks = expected_suggestions(tac_module, data, lowers, ss, max_num, tac_module.OPT_WORD_IN)
+            expected = data.words(ranks)
+            if data.fuzzy_index is not None and got != expected and got == expected[:len(got)]:
+                exact = data.words(expected_suggestions(tac_module, data, lowers, ss, max_num, tac_module.OPT_WORD_IN, False))
+                if len(got) >= len(exact):
+                    short += 1  # あいまい検索の候補が次の入力に持ち越された
+                    continue
+            if got != expected:
+                if mismatches < 3:
+                    print('  {} {!r}: got {!r}, expected {!r}'.format(name, q, got, expected))
+                mismatches += 1
+        print('{:<16} {:>6} queries  {:>4} mismatches  {:>4} short'.format(name, len(queries), mismatches, short))
+        sys.stdout.flush()
+        failures += mismatches
+    return failures
+
+
+# ----------------------------------------------------------------------------------------
+def run_child(args):
+    """
+    1つの設定でスクリプトを起動して計測し、結果をJSONで標準出力に書き込む(子プロセスで実行する)
+    """
+    sys.path.insert(0, BENCH_DIR)  # ベンチマーク用の Npp モジュールを使う
+    sys.path.insert(1, os.path.dirname(BENCH_DIR))
+    from Npp import editor, console
+    import tagAutoComplete as tac_module
+
+    console.verbose = args['verbose']
+    for name, value in args['settings'].items():
+        setattr(tac_module, name, value)
+    tac_module.WILDCARD_DIR = args['wildcard_dir'].encode('utf-8')
+    tac_module.LORA_DIR = args['lora_dir'].encode('utf-8')
+    result = {}
+
+    # 起動時間
+    start = time.time()
+    tac = tac_module.TagAutoComplete([args['tagfile']], args['history'] if tac_module.USE_HISTORY else None, args['loracache'])
+    result['init'] = time.time() - start
+    loaded = {}
+    conds = {
+        'tags': lambda: tac.worker is not None and tac.worker.is_alive(),
+        'wildcards': lambda: tac.wcm.scanner is not None,
+        'loras': lambda: tac.lom.scanner is not None,
+    }
+
+    def check_loaded():
+        for name, cond in conds.items():
+            if name not in loaded and cond():
+                loaded[name] = time.time() - start
+        return len(loaded) == len(conds)
+    wait_until(check_loaded)
+    result['load'] = loaded
+    result['startup'] = max(loaded.values() or [float('nan')])
+    if args['startup_only']:
+        tac.destroy_instance()
+        result['peak_mb'] = peak_memory_mb()
+        return result
+
+    # 補完メニューの表示(または検索の終了)を待つために、表示処理の呼び出しを記録する
+    done = threading.Event()
+    show_suggestions = tac.show_suggestions
+
+    def traced_show_suggestions(generation, word, suggestions):
+        show_suggestions(generation, word, suggestions)
+        done.set()
+    tac.show_suggestions = traced_show_suggestions
+
+    key_times = []
+    select_times = []
+    shown = 0
+    for ev in json.load(open(args['session'])):
+        if ev[0] == 'key':
+            editor.type_char(ev[1].encode('utf-8'))
+            word = editor.getWord(editor.getCurrentPos(), True)
+            done.clear()
+            count = editor.show_count
+            t0 = time.time()
+            tac.on_char_added({'ch': ord(ev[1][0])})
+            if len(word) >= tac_module.NUM_SHOW:
+                if not done.wait(60.0):
+                    raise RuntimeError('suggestion timed out: {!r}'.format(word))
+            key_times.append(time.time() - t0)
+            shown += editor.show_count - count
+        elif ev[0] == 'backspace':
+            editor.backspace()
+        elif ev[0] == 'select':
+            item = editor.select_item(ev[1])
+            if item is not None:
+                t0 = time.time()
+                tac.on_autocompletion_selected({'text': item})
+                select_times.append(time.time() - t0)
+
+    tac.dump_stats()
+    tac.destroy_instance()
+    result['keys'] = len(key_times)
+    result['shown'] = shown
+    result['key_ms'] = [percentile(key_times, p) * 1000 for p in (50, 95, 99)] + [max(key_times or [0]) * 1000]
+    result['select_ms'] = [percentile(select_times, p) * 1000 for p in (50, 95, 99)]
+    result['peak_mb'] = peak_memory_mb()
+    return result
+
+
+# ----------------------------------------------------------------------------------------
+def spawn_child(args):
+    """
+    子プロセスで計測を実行して結果を返す
+    """
+    p = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', json.dumps(args)], stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        raise RuntimeError('benchmark child failed: {}'.format(args['name']))
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+# ----------------------------------------------------------------------------------------
+def format_ms(values):
+    return ' / '.join(['{:7.2f}'.format(v) for v in values])
+
+
+# ----------------------------------------------------------------------------------------
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='tagAutoComplete.py benchmark')
+    parser.add_argument('--rows', default='10000,100000', help='タグファイルの行数(カンマ区切り)')
+    parser.add_argument('--configs', help='計測する設定(カンマ区切り。省略時は全ての設定)')
+    parser.add_argument('--wildcards', type=int, default=2000, help='ワイルドカードファイルの数')
+    parser.add_argument('--loras', type=int, default=1000, help='Loraファイルの数')
+    parser.add_argument('--words', type=int, default=300, help='合成する入力の単語数')
+    parser.add_argument('--session', help='再生する入力の記録(JSON)')
+    parser.add_argument('--save-session', help='合成した入力の記録を保存するファイル')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='作成したファイルを削除しない')
+    parser.add_argument('--verbose', action='store_true', help='スクリプトのコンソール出力を表示する')
+    parser.add_argument('--verify', action='store_true', help='計測の代わりに、検索結果を全件を調べた結果と比べる(--configs は VERIFY_CONFIGS から選ぶ)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    opts = parser.parse_args(argv)
+
+    if opts.child:
+        print(json.dumps(run_child(json.loads(opts.child))))
+        sys.stdout.flush()
+        os._exit(0)  # 終了処理中に別スレッドが動いて例外を表示しないよう、すぐに終了する
+
+    configs = dict(VERIFY_CONFIGS if opts.verify else CONFIGS)
+    names = [c for c in opts.configs.split(',') if c] if opts.configs is not None else [c[0] for c in (VERIFY_CONFIGS if opts.verify else CONFIGS)]
+    for name in names:
+        if name not in configs:
+            parser.error('unknown config: {}'.format(name))
+
+    workdir = tempfile.mkdtemp(prefix='tac_bench_')
+    try:
+        if opts.verify:
+            failures = 0
+            for rows in [int(r) for r in opts.rows.split(',') if r]:
+                tagfile = os.path.join(workdir, 'tags_{}.csv'.format(rows))
+                tags = make_tagfile(tagfile, rows, opts.seed)
+                events = json.load(open(opts.session)) if opts.session else make_session(tags, [], [], opts.words, opts.seed)
+                print('rows: {}'.format(rows))
+                failures += run_verify(tagfile, session_queries(events), names)
+            return 1 if failures else 0
+
+        wildcard_dir = os.path.join(workdir, 'wildcards')
+        lora_dir = os.path.join(workdir, 'loras')
+        wildcards = make_tree(wildcard_dir, opts.wildcards, '.txt', opts.seed)
+        loras = make_tree(lora_dir, opts.loras, '.safetensors', opts.seed + 1, safetensors_header)
+
+        print('{:>8} {:<13} {:>8} {:>8} {:>8} {:>8} {:>6}  {:<37} {:<25} {:>8}'.format(
+            'rows', 'config', 'cold(s)', 'warm(s)', 'wc(s)', 'lora(s)', 'keys', 'key ms p50 / p95 / p99 / max', 'select ms p50 / p95 / p99', 'peak MB'))
+        for rows in [int(r) for r in opts.rows.split(',') if r]:
+            tagfile = os.path.join(workdir, 'tags_{}.csv'.format(rows))
+            tags = make_tagfile(tagfile, rows, opts.seed)
+            if opts.session:
+                session = opts.session
+            else:
+                session = os.path.join(workdir, 'session_{}.json'.format(rows))
+                events = make_session(tags, wildcards, loras, opts.words, opts.seed)
+                for path in filter(None, [session, opts.save_session]):
+                    with open(path, 'w') as f:
+                        json.dump(events, f)
+
+            for name in names:
+                history = os.path.join(workdir, 'history.txt')
+                loracache = os.path.join(workdir, 'lora.cache')
+                for path in (tagfile + '.cache', tagfile + '.cache.tmp', history, history + '.log', loracache):
+                    if os.path.exists(path):
+                        os.remove(path)
+                args = {'name': name, 'settings': configs[name], 'tagfile': tagfile, 'history': history, 'loracache': loracache, 'wildcard_dir': wildcard_dir,
+                        'lora_dir': lora_dir, 'session': session, 'verbose': opts.verbose, 'startup_only': False}
+                cold = spawn_child(args)  # キャッシュなしで起動して入力を再生する
+                args['startup_only'] = True
+                warm = spawn_child(args)  # キャッシュありで起動する
+                print('{:>8} {:<13} {:8.2f} {:8.2f} {:8.2f} {:8.2f} {:>6}  {:<37} {:<25} {:>8}'.format(
+                    rows, name, cold['startup'], warm['startup'], cold['load'].get('wildcards', 0), cold['load'].get('loras', 0),
+                    cold['keys'], format_ms(cold['key_ms']), format_ms(cold['select_ms']),
+                    '{:.1f}'.format(cold['peak_mb']) if cold['peak_mb'] is not None else '-'))
+                sys.stdout.flush()
+    finally:
+        if opts.keep:
+            print('files: {}'.format(workdir))
+        else:
+            shutil.rmtree(workdir, True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -3,6 +3,15 @@
 
 import os
 import csv
+import heapq
+import json
+import marshal
+import struct
+import threading
+import time
+from array import array
+from collections import deque
+from bisect import bisect_left, bisect_right, insort
 from Npp import editor, notepad, console, SCINTILLANOTIFICATION, NOTIFICATION
 
 # ----------------------------------------------------------------------------------------
@@ -38,6 +47,13 @@ from Npp import editor, notepad, console, SCINTILLANOTIFICATION, NOTIFICATION
 #   TAG_FILENAME: 入力補完に使用するタグ一覧のファイル名を指定する
 #     - ファイルはこのスクリプトと同じフォルダに入れてください
 #     - リストの上から順番に表示します
+#     - ['my_tags.csv', 'team_tags.csv', 'danbooru.csv'] のようにリストで複数のファイルを指定できます
+#       - 先頭のファイルから順番に表示します(RANK_BY_COUNTがFalseの時)
+#       - 同じタグ(大文字小文字の違いは無視します)が複数のファイルにある場合は、先頭に近いファイルの行(投稿数、別名)を使用します
+#       - 一部のファイルが更新された時は、更新されたファイルだけを読み直します
+#   USE_TAG_CACHE: タグファイルの読み込み結果をキャッシュファイル(タグファイル名 + '.cache')に保存する
+#     - 次回以降の起動時はキャッシュファイルから読み込むため、起動が速くなります
+#     - タグファイルが更新された時やキャッシュファイルが壊れている時は自動で作り直します
 #   NUM_SHOW: 入力候補を表示するまでに必要な文字数
 #   MAX_SHOW_WORDS: メニューに表示する候補の最大値
 #   REPLACE_UB_TO_SPACE: アンダーバーをスペースに置換する
@@ -47,6 +63,31 @@ from Npp import editor, notepad, console, SCINTILLANOTIFICATION, NOTIFICATION
 #   OPT_WORD_IN: タグ検索時の設定
 #     - True: 部分一致(例: behindと入力した時にfrom_behindが候補に出る)
 #     - False: 前方一致(例: behindと入力した時にfrom_behindは出ない)
+#   RANK_BY_COUNT: タグの表示順の設定
+#     - True: CSVファイルの投稿数の列(TAG_COUNT_COLUMN)の値が大きい順に表示する
+#     - False: CSVファイルの上から順番に表示する
+#   TAG_COUNT_COLUMN: 投稿数が書かれている列の番号(一列目を0として数える。A1111用のCSVファイルでは2)
+#   PREFIX_MATCH_WEIGHT, PARTIAL_MATCH_WEIGHT: RANK_BY_COUNTがTrueの時に、前方一致と部分一致の候補の投稿数に掛ける重み
+#     - 部分一致の重みを小さくすると、前方一致の候補が優先して表示されます
+#     - 部分一致の重みを前方一致より大きくすることもできますが、候補を多く確認するため検索が遅くなります
+#   USE_TAG_ALIAS: タグの別名(エイリアス)でも検索する(例: pantsuと入力した時にpantiesが候補に出る)
+#   TAG_ALIAS_COLUMN: 別名が書かれている列の番号(一列目を0として数える。A1111用のCSVファイルでは3)
+#     - 複数の別名はカンマ区切りで書いてください(例: panties,0,100,"pantsu,underwear")
+#   FUZZY_MAX_DISTANCE: あいまい検索で許容する入力ミスの文字数(編集距離。0にするとあいまい検索を使用しません)
+#     - 完全一致の候補が MAX_SHOW_WORDS 個に満たない時に、入力ミスを含む候補を追加します(例: lookng_at -> looking_at_viewer)
+#     - 2にすると大きな入力ミスにも対応しますが、メモリの使用量と読み込み時間が増えます
+#     - あいまい検索用のインデックスには NGRAM_INDEX_MAX_MB のような上限がないため、初期設定では使用しません
+#   FUZZY_PREFIX_LENGTH: あいまい検索に使用するタグの先頭の文字数
+#     - この文字数以上を入力した時にあいまい検索を行ないます(前方一致で検索します)
+#     - 大きくすると候補を絞り込みやすくなり検索が速くなりますが、メモリの使用量が増えます
+#   NGRAM_INDEX_MAX_MB: 部分一致検索用のインデックス(N-gram)に使用するメモリの上限(MB)
+#     - タグの別名のインデックスも合わせた上限です(タグのインデックスを優先して作成します)
+#     - インデックスの推定サイズが上限を超える場合はインデックスを作成せずに全件を検索します
+#     - 0にするとインデックスを使用しません(メモリの少ない環境向け)
+#     - 目安: 20万行のCSVファイルでは、読み込み時間とメモリの使用量がそれぞれ次のように増えます
+#       (タグファイルの更新時は作り直すため、読み込みが終わるまでは更新前のデータと合わせて2倍近くのメモリを使用します)
+#       N-gramインデックス: 約2.5秒、約70MB / USE_TAG_ALIAS: 約2秒、約40MB
+#       FUZZY_MAX_DISTANCE = 1: 約0.5秒、約5MB / FUZZY_MAX_DISTANCE = 2: 約4秒、約10MB
 #   WILDCARD_DIR: ワイルドカードファイルが保存されているディレクトリ(空にするとワイルドカード入力の補完を無効化します)
 #     - ワイルドカードファイルはテキスト形式(拡張子:txt)のみ対応しています
 #   WILDCARD_ADD_SEPARATER: ワイルドカード補完時に末尾に区切り文字を付ける
@@ -54,9 +95,25 @@ from Npp import editor, notepad, console, SCINTILLANOTIFICATION, NOTIFICATION
 #     - Loraファイルは(拡張子:safetensors)のみ対応しています
 #   LORA_DEF_STRENGTH: Lora補完で使用するデフォルトのLoraの強度
 #   LORA_ADD_SEPARATER: Lora補完時に末尾に区切り文字を付ける
+#   LORA_TRIGGER_WORDS: Lora補完の後に、Loraの学習に使われたタグ(トリガーワード)の候補を表示する数(0にすると表示しません)
+#     - safetensorsファイルの先頭にあるメタデータ(ss_tag_frequency等)だけを読み込みます(モデル本体は読み込みません)
+#     - 読み込み結果はスクリプトと同じフォルダの 'tagAutoComplete_lora.cache' に保存します
+#   DIR_RESCAN_INTERVAL: タグファイルの更新の確認と、ワイルドカード、Loraのディレクトリを再スキャンする間隔(秒)
+#     - ファイルの切り替え時、保存時にも確認します(更新日時が変わったディレクトリだけを読み直します)
+#     - タグファイルが更新された時は読み込み直します(読み込みが終わるまでは更新前のタグで補完します)
+#     - 0にすると確認しません(スクリプトの起動時だけ読み込みます)
+#   USE_HISTORY: メニューから選択した回数を記録し、よく使う候補をメニューの先頭に表示する
+#     - 選択した回数はスクリプトと同じフォルダの HISTORY_FILENAME に保存します(選択した候補を追記したファイル HISTORY_FILENAME + '.log' は定期的にまとめます)
+#     - 記録を消したい時はスクリプトを終了してから2つのファイルを削除してください
+#   HISTORY_FILENAME: 選択した回数を保存するファイル名
+#   HISTORY_SHOW_WORDS: メニューの先頭に表示するよく使う候補の最大数
+#   PROFILE_MODE: 入力補完の各処理にかかった時間を計測する(動作が重い時の原因調査用)
+#     - 計測結果は tagAutoComplete_stats.py を実行するとコンソールに表示されます
+#   PROFILE_SLOW_MS: PROFILE_MODEがTrueの時に、この時間(ミリ秒)以上かかった入力をコンソールに表示する
 
 TARGET_FILENAME = '.txt'
 TAG_FILENAME = 'danbooru.csv'
+USE_TAG_CACHE = True
 NUM_SHOW = 2
 MAX_SHOW_WORDS = 7
 REPLACE_UB_TO_SPACE = True
@@ -64,74 +121,1316 @@ ESCAPE_CHAR = '()'
 TEXT_SEPARATER = ', '
 TRIM_SEPARATER_SPACE = True
 OPT_WORD_IN = True
+RANK_BY_COUNT = False
+TAG_COUNT_COLUMN = 2
+PREFIX_MATCH_WEIGHT = 1.0
+PARTIAL_MATCH_WEIGHT = 0.5
+USE_TAG_ALIAS = True
+TAG_ALIAS_COLUMN = 3
+FUZZY_MAX_DISTANCE = 0
+FUZZY_PREFIX_LENGTH = 4
+NGRAM_INDEX_MAX_MB = 64
 WILDCARD_DIR = r'C:\my\wildcard'
 WILDCARD_ADD_SEPARATER = True
 LORA_DIR = r'C:\my\loras'
 LORA_DEF_STRENGTH = '1'
 LORA_ADD_SEPARATER = False
+LORA_TRIGGER_WORDS = 10
+DIR_RESCAN_INTERVAL = 60
+USE_HISTORY = True
+HISTORY_FILENAME = 'tagAutoComplete_history.txt'
+HISTORY_SHOW_WORDS = 3
+PROFILE_MODE = False
+PROFILE_SLOW_MS = 100
+
+
+def array_from_bytes(b):
+    """
+    バイト列から配列(array('i'))を作成する
+    b: array.tostring() で作成したバイト列
+    """
+    a = array('i')
+    a.fromstring(b)
+    return a
+
+
+def patch_sorted_list(lst, added, removed):
+    """
+    ソート済みのリストに要素を追加、削除する(ソート順を保つ)
+    lst: ソート済みのリスト
+    added: 追加する要素
+    removed: 削除する要素
+    """
+    for item in removed:
+        i = bisect_left(lst, item)
+        if i < len(lst) and lst[i] == item:
+            del lst[i]
+    for item in added:
+        insort(lst, item)
+
+
+class TagStore(object):
+    """
+    タグ一覧をまとめて保持するクラス
+    タグ1件ごとに文字列オブジェクトを持たず、区切り文字で連結した1つの文字列と
+    各タグの開始位置の配列で保持する(表示用と検索用の小文字化した文字列の2つ)
+    """
+    SEP = u'\n'
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, words):
+        """
+        words: 保持する文字列のリスト(リストの順番を順位として扱う)
+        """
+        lower_words = []
+        for w in words:
+            lw = w.lower()
+            if len(lw) != len(w):  # 小文字化で文字数が変わる文字はそのままにする(開始位置を共有するため)
+                lw = u''.join([c.lower() if len(c.lower()) == 1 else c for c in w])
+            lower_words.append(lw)
+
+        self.offsets = array('i', [0])  # 各タグの開始位置(末尾に全体の長さを持つ)
+        pos = 0
+        for w in words:
+            pos += len(w) + 1
+            self.offsets.append(pos)
+        self.text = self.SEP.join(words) + self.SEP if words else u''
+        self.lower_text = self.SEP.join(lower_words) + self.SEP if words else u''
+
+    # ----------------------------------------------------------------------------------------
+    def dump(self):
+        """
+        キャッシュファイルに保存する内容を返す
+        """
+        return {'text': self.text, 'lower_text': self.lower_text, 'offsets': self.offsets.tostring()}
+
+    # ----------------------------------------------------------------------------------------
+    @classmethod
+    def restore(cls, state):
+        """
+        キャッシュファイルの内容から作成する
+        state: dump() で作成したデータ
+        """
+        store = cls.__new__(cls)
+        store.text = state['text']
+        store.lower_text = state['lower_text']
+        store.offsets = array_from_bytes(state['offsets'])
+        return store
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # ----------------------------------------------------------------------------------------
+    def get(self, r):
+        """
+        表示用の文字列を返す
+        r: 順位
+        """
+        return self.text[self.offsets[r]:self.offsets[r+1]-1]
+
+    # ----------------------------------------------------------------------------------------
+    def lower(self, r):
+        """
+        小文字化した文字列を返す
+        r: 順位
+        """
+        return self.lower_text[self.offsets[r]:self.offsets[r+1]-1]
+
+    # ----------------------------------------------------------------------------------------
+    def contains(self, r, ss):
+        """
+        文字列を含むかどうかを返す
+        r: 順位
+        ss: 小文字化済みの検索文字列
+        """
+        return self.lower_text.find(ss, self.offsets[r], self.offsets[r+1]-1) != -1
+
+    # ----------------------------------------------------------------------------------------
+    def startswith(self, r, ss):
+        """
+        文字列で始まるかどうかを返す
+        r: 順位
+        ss: 小文字化済みの検索文字列
+        """
+        return self.lower_text.startswith(ss, self.offsets[r], self.offsets[r+1]-1)
+
+    # ----------------------------------------------------------------------------------------
+    def matches(self, ss):
+        """
+        部分一致する候補の順位を元の順番で返すイテレータ(連結した文字列を先頭から検索する)
+        ss: 小文字化済みの検索文字列
+        """
+        start = 0
+        while True:
+            pos = self.lower_text.find(ss, start)
+            if pos == -1 or pos == len(self.lower_text):  # 空の検索文字列は末尾にも一致する
+                return
+            r = bisect_right(self.offsets, pos) - 1  # 見つかった位置からタグの順位を求める
+            if pos + len(ss) < self.offsets[r+1]:  # 区切り文字をまたいでいないか確認する
+                yield r
+            start = self.offsets[r+1]  # 次のタグから検索を続ける
+
+
+class PrefixIndex(object):
+    """
+    前方一致検索用のインデックス
+    小文字化したキーのソート順を保持し、二分探索で前方一致する範囲を求める
+    検索結果は元のリストの順番(順位)で返す
+    """
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, store):
+        """
+        store: インデックスを作成するTagStore
+        """
+        self.store = store
+        self.order = array('i', sorted(range(len(store)), key=store.lower))  # ソート後の位置 -> 元の順位
+        self.pos = array('i', [0]) * len(store)  # 元の順位 -> ソート後の位置
+        for p, r in enumerate(self.order):
+            self.pos[r] = p
+
+    # ----------------------------------------------------------------------------------------
+    def dump(self):
+        """
+        キャッシュファイルに保存する内容を返す
+        """
+        return {'order': self.order.tostring(), 'pos': self.pos.tostring()}
+
+    # ----------------------------------------------------------------------------------------
+    @classmethod
+    def restore(cls, store, state):
+        """
+        キャッシュファイルの内容から作成する
+        store: インデックスを作成したTagStore
+        state: dump() で作成したデータ
+        """
+        index = cls.__new__(cls)
+        index.store = store
+        index.order = array_from_bytes(state['order'])
+        index.pos = array_from_bytes(state['pos'])
+        return index
+
+    # ----------------------------------------------------------------------------------------
+    def bisect(self, ss, lo=0):
+        """
+        ソート済みのキーに ss を挿入する位置を返す
+        ss: 小文字化済みの文字列
+        lo: 探索を開始する位置
+        """
+        hi = len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.store.lower(self.order[mid]) < ss:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # ----------------------------------------------------------------------------------------
+    def matches(self, ss, max_num):
+        """
+        前方一致する候補の順位を元の順番で返すイテレータ
+        ss: 小文字化済みの検索文字列
+        max_num: 取得するデータの最大個数(検索方法の選択に使用する)
+        """
+        lo = self.bisect(ss)
+        hi = self.bisect(ss + u'\uffff', lo)
+        n = hi - lo
+
+        # 一致する範囲が狭い時は範囲内を順位の順番に並べ替え、
+        # 広い時は元の順番に走査する(すぐに max_num 個見つかる)
+        if n * n <= max_num * len(self.order):
+            return iter(sorted(self.order[lo:hi]))
+        return (r for r, p in enumerate(self.pos) if lo <= p < hi)
+
+
+class NgramIndex(object):
+    """
+    部分一致検索用のインデックス(N-gramの転置インデックス)
+    N-gramごとに、そのN-gramを含むキーの順位を昇順で保持する
+    """
+    N = 3
+    BYTES_PER_POSTING = 8  # 1件あたりの推定メモリ使用量(配列の要素 + 辞書のオーバーヘッド)
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, store):
+        """
+        store: インデックスを作成するTagStore
+        """
+        n = self.N
+        self.store = store
+        self.postings = {}
+        for r in range(len(store)):
+            key = store.lower(r)
+            for g in set([key[i:i+n] for i in range(len(key) - n + 1)]):
+                posting = self.postings.get(g)
+                if posting is None:
+                    posting = self.postings[g] = array('i')
+                posting.append(r)
+
+    # ----------------------------------------------------------------------------------------
+    def dump(self):
+        """
+        キャッシュファイルに保存する内容を返す
+        """
+        return {'postings': dict([(g, self.posting(g).tostring()) for g in self.postings])}
+
+    # ----------------------------------------------------------------------------------------
+    @classmethod
+    def restore(cls, store, state):
+        """
+        キャッシュファイルの内容から作成する(リストは検索で使用する時に配列に変換する)
+        store: インデックスを作成したTagStore
+        state: dump() で作成したデータ
+        """
+        index = cls.__new__(cls)
+        index.store = store
+        index.postings = state['postings']
+        return index
+
+    # ----------------------------------------------------------------------------------------
+    def posting(self, g):
+        """
+        N-gramを含むキーの順位のリストを返す(存在しない場合はNone)
+        g: N-gram
+        """
+        posting = self.postings.get(g)
+        if posting is not None and not isinstance(posting, array):
+            posting = self.postings[g] = array_from_bytes(posting)  # キャッシュから読み込んだバイト列を変換する
+        return posting
+
+    # ----------------------------------------------------------------------------------------
+    @classmethod
+    def estimate_mb(cls, store):
+        """
+        インデックスを作成した時のおおよそのメモリ使用量(MB)を返す
+        store: インデックスを作成するTagStore
+        """
+        # 区切り文字を含めたタグの長さから各タグのN-gramの数を求める
+        offsets = store.offsets
+        num = sum([max(offsets[r+1] - offsets[r] - cls.N, 0) for r in range(len(store))])
+        return num * cls.BYTES_PER_POSTING / (1024.0 * 1024.0)
+
+    # ----------------------------------------------------------------------------------------
+    def shortest(self, ss):
+        """
+        検索文字列のN-gramのうち、最も短い順位のリストを返す(含まれないN-gramがある場合は空のリスト)
+        ss: 小文字化済みの検索文字列(N文字以上)
+        """
+        n = self.N
+        shortest = None
+        for i in range(len(ss) - n + 1):
+            posting = self.posting(ss[i:i+n])
+            if posting is None:
+                return []  # 含まれないN-gramがある場合は一致する候補もない
+            if shortest is None or len(posting) < len(shortest):
+                shortest = posting
+        return shortest
+
+    # ----------------------------------------------------------------------------------------
+    def matches(self, ss):
+        """
+        部分一致する候補の順位を元の順番で返すイテレータ
+        ss: 小文字化済みの検索文字列(N文字以上)
+        """
+        # 最も短いリストの候補を順番に確認する(N-gramが全て含まれていても一致するとは限らない)
+        return (r for r in self.shortest(ss) if self.store.contains(r, ss))
+
+
+class FuzzyIndex(object):
+    """
+    あいまい検索用のインデックス(SymSpell方式の削除辞書)
+    キーの先頭 prefix_len 文字から max_distance 文字までを削除した文字列ごとに、キーの順位を昇順で保持する
+    検索文字列からも同様に文字を削除して辞書を引き、見つかった候補を編集距離で確認する
+    """
+    MAX_CHECKS = 300  # 1回の検索で編集距離を確認する候補の最大数(入力の遅延を防ぐ。続きは次の入力時に確認する)
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, store, max_distance, prefix_len):
+        """
+        store: インデックスを作成するTagStore
+        max_distance: 許容する編集距離
+        prefix_len: インデックスに使用するキーの先頭の文字数(検索文字列もこの文字数以上が必要)
+        """
+        self.store = store
+        self.max_distance = max_distance
+        self.prefix_len = prefix_len
+        self.postings = {}
+        min_len = prefix_len - max_distance  # これより短い文字列は検索文字列から作られないため登録しない
+        for r in range(len(store)):
+            for key in self.deletes(store.lower(r)[:prefix_len], max_distance):
+                if len(key) < min_len:
+                    continue
+                posting = self.postings.get(key)
+                if posting is None:
+                    posting = self.postings[key] = array('i')
+                posting.append(r)
+
+    # ----------------------------------------------------------------------------------------
+    def dump(self):
+        """
+        キャッシュファイルに保存する内容を返す
+        """
+        return {'postings': dict([(key, self.posting(key).tostring()) for key in self.postings]),
+                'max_distance': self.max_distance, 'prefix_len': self.prefix_len}
+
+    # ----------------------------------------------------------------------------------------
+    @classmethod
+    def restore(cls, store, state):
+        """
+        キャッシュファイルの内容から作成する(リストは検索で使用する時に配列に変換する)
+        store: インデックスを作成したTagStore
+        state: dump() で作成したデータ
+        """
+        index = cls.__new__(cls)
+        index.store = store
+        index.max_distance = state['max_distance']
+        index.prefix_len = state['prefix_len']
+        index.postings = state['postings']
+        return index
+
+    # ----------------------------------------------------------------------------------------
+    def posting(self, key):
+        """
+        キーを持つ候補の順位のリストを返す(存在しない場合はNone)
+        key: 文字を削除した文字列
+        """
+        posting = self.postings.get(key)
+        if posting is not None and not isinstance(posting, array):
+            posting = self.postings[key] = array_from_bytes(posting)  # キャッシュから読み込んだバイト列を変換する
+        return posting
+
+    # ----------------------------------------------------------------------------------------
+    @staticmethod
+    def deletes(word, max_distance):
+        """
+        文字列から max_distance 文字までを削除した文字列のセットを返す(元の文字列を含む)
+        word: 文字列
+        max_distance: 削除する最大の文字数
+        """
+        result = set([word])
+        frontier = [word]
+        for _ in range(max_distance):
+            next_frontier = []
+            for w in frontier:
+                for i in range(len(w)):
+                    d = w[:i] + w[i+1:]
+                    if d not in result:
+                        result.add(d)
+                        next_frontier.append(d)
+            frontier = next_frontier
+        return result
+
+    # ----------------------------------------------------------------------------------------
+    @staticmethod
+    def prefix_distance(ss, key, max_distance):
+        """
+        検索文字列とキーの先頭部分との編集距離の最小値を返す(max_distance を超える場合は max_distance + 1)
+        ss: 検索文字列
+        key: キー
+        max_distance: 許容する編集距離
+        """
+        key = key[:len(ss) + max_distance]
+        prev = list(range(len(key) + 1))
+        for i, c in enumerate(ss):
+            cur = [i + 1]
+            for j, k in enumerate(key):
+                cur.append(min(prev[j+1] + 1, cur[j] + 1, prev[j] + (c != k)))
+            if min(cur) > max_distance:
+                return max_distance + 1  # これ以降は距離が小さくならない
+            prev = cur
+        return min(prev)
+
+    # ----------------------------------------------------------------------------------------
+    def match(self, r, ss):
+        """
+        候補が検索文字列に近いかどうかを返す
+        r: 候補の順位
+        ss: 小文字化済みの検索文字列
+        """
+        return self.prefix_distance(ss, self.store.lower(r), self.max_distance) <= self.max_distance
+
+    # ----------------------------------------------------------------------------------------
+    def candidates(self, ss):
+        """
+        辞書を引いて見つかった候補の順位を元の順番で返すイテレータ(編集距離は確認しない)
+        ss: 小文字化済みの検索文字列(prefix_len 文字以上)
+        """
+        postings = [p for p in [self.posting(key) for key in self.deletes(ss[:self.prefix_len], self.max_distance)] if p is not None]
+        last = -1
+        for r in heapq.merge(*postings):  # 複数のリストを順位の順番にまとめる
+            if r != last:
+                last = r
+                yield r
+
+    # ----------------------------------------------------------------------------------------
+    def cursor(self, prev, ss):
+        """
+        あいまい検索用のカーソルを返す(前回のカーソルが使える場合は絞り込んで再利用する)
+        prev: 前回のあいまい検索のカーソル(ない場合はNone)
+        ss: 小文字化済みの検索文字列(prefix_len 文字以上)
+        """
+        if prev is not None and prev.index is self and ss.startswith(prev.ss):
+            prev.narrow(ss)
+            return prev
+        return FuzzyCursor(self, ss)
+
+
+class FuzzyCursor(object):
+    """
+    あいまい検索の続きを取得するためのカーソル
+    辞書を引く文字列(検索文字列の先頭 prefix_len 文字)は末尾に文字を追加しても変わらず、
+    文字を追加して編集距離が小さくなることもないため、前回見つけた候補を確認し直して前回の続きから探す
+    """
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, index, ss):
+        """
+        index: 検索するFuzzyIndex
+        ss: 小文字化済みの検索文字列(prefix_len 文字以上)
+        """
+        self.index = index
+        self.ss = ss
+        self.matches = index.candidates(ss)
+        self.hits = []  # 取得済みの候補の順位(完全一致の候補も含む)
+        self.exhausted = False  # 全ての候補を確認済み
+
+    # ----------------------------------------------------------------------------------------
+    def narrow(self, ss):
+        """
+        取得済みの候補を新しい検索文字列で絞り込む
+        ss: 小文字化済みの検索文字列
+        """
+        self.hits = [r for r in self.hits if self.index.match(r, ss)]
+        self.ss = ss
+
+    # ----------------------------------------------------------------------------------------
+    def take(self, max_num, exclude):
+        """
+        先頭から max_num 個の候補の順位を返す(足りない時は MAX_CHECKS 個まで続きを確認する)
+        max_num: 取得するデータの最大個数
+        exclude: 結果に含めない候補の順位(完全一致で取得済みの候補)
+        """
+        result = [r for r in self.hits if r not in exclude]
+        checked = 0
+        while len(result) < max_num and not self.exhausted and checked < self.index.MAX_CHECKS:
+            r = next(self.matches, None)
+            if r is None:
+                self.exhausted = True
+                break
+            checked += 1
+            if self.index.match(r, self.ss):
+                self.hits.append(r)
+                if r not in exclude:
+                    result.append(r)
+        return result[:max_num]
+
+
+class SuggestCursor(object):
+    """
+    検索結果の続きを取得するためのカーソル
+    検索文字列が前回の検索文字列の末尾に文字を追加したものである時は、
+    前回の検索結果を絞り込み、前回の検索の続きから候補を探す
+    """
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, data, ss, word_in, kind, matches, size=None):
+        """
+        data: 検索対象のSuggestData
+        ss: 小文字化済みの検索文字列
+        word_in: Trueで部分一致、Falseで前方一致
+        kind: 検索方法('prefix', 'ngram', 'scan')
+        matches: 候補の順位を元の順番で返すイテレータ
+        size: イテレータが確認する候補の数('ngram'の時のみ。それ以外はNone)
+        """
+        self.data = data
+        self.ss = ss
+        self.word_in = word_in
+        self.kind = kind
+        self.matches = matches
+        self.size = size
+        self.hits = []  # 取得済みの候補の順位
+        self.exhausted = False  # 全ての候補を取得済み
+
+    # ----------------------------------------------------------------------------------------
+    def can_narrow(self, data, ss, word_in, kind):
+        """
+        前回の検索結果を絞り込んで使用できるかどうかを返す
+        data: 検索対象のSuggestData
+        ss: 小文字化済みの検索文字列
+        word_in: Trueで部分一致、Falseで前方一致
+        kind: 新しく検索する場合の検索方法
+        """
+        if data is not self.data or word_in != self.word_in or not ss.startswith(self.ss):
+            return False  # バックスペースや別の単語の入力
+        if self.exhausted:
+            return True  # 全ての候補を取得済みなら絞り込むだけで済む
+        # 途中の場合は前回のイテレータの続きを探すことになるため、
+        # 新しく検索した時より確認する候補が増えない場合(N-gramのリストが新しい検索文字列のもの以下の長さ)だけ再利用する
+        # (前方一致と全件検索は新しく検索した方が速い)
+        return kind == self.kind == 'ngram' and data.search_size(kind, ss) >= self.size
+
+    # ----------------------------------------------------------------------------------------
+    def narrow(self, ss):
+        """
+        取得済みの候補を新しい検索文字列で絞り込む
+        ss: 小文字化済みの検索文字列
+        """
+        self.hits = [r for r in self.hits if self.data.match(r, ss, self.word_in)]
+        self.ss = ss
+
+    # ----------------------------------------------------------------------------------------
+    def take(self, max_num):
+        """
+        先頭から max_num 個の候補の順位を返す(足りない時は続きを探す)
+        max_num: 取得するデータの最大個数
+        """
+        if len(self.hits) < max_num and not self.exhausted:
+            for r in self.matches:
+                # イテレータは前回までの検索文字列で検索しているため、現在の検索文字列で確認する
+                if self.data.match(r, self.ss, self.word_in):
+                    self.hits.append(r)
+                    if len(self.hits) >= max_num:
+                        break
+            else:
+                self.exhausted = True
+        return self.hits[:max_num]
+
+
+class SuggestData(object):
+    """
+    補完候補の一覧と検索用のインデックスをまとめて保持するクラス
+    作成後は変更しないため、別スレッドで作成したものと丸ごと入れ替えて使用する
+    """
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, store, prefix_index=None, ngram_index=None, counts=None, fuzzy_index=None, alias_index=None):
+        """
+        store: 補完候補のTagStore
+        prefix_index: 前方一致検索用のインデックス(省略時は作成する)
+        ngram_index: 部分一致検索用のインデックス(Noneの時は使用しない)
+        counts: 候補ごとの投稿数の配列(投稿数順に並べた時のみ。Noneの時は使用しない)
+        fuzzy_index: あいまい検索用のインデックス(Noneの時は使用しない)
+        alias_index: 別名検索用のインデックス(Noneの時は使用しない)
+        """
+        self.store = store
+        self.prefix_index = prefix_index if prefix_index is not None else PrefixIndex(store)
+        self.ngram_index = ngram_index
+        self.counts = counts
+        self.fuzzy_index = fuzzy_index
+        self.alias_index = alias_index
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.store)
+
+    # ----------------------------------------------------------------------------------------
+    def match(self, r, ss, word_in):
+        """
+        候補が検索文字列に一致するかどうかを返す
+        r: 候補の順位
+        ss: 小文字化済みの検索文字列
+        word_in: Trueで部分一致、Falseで前方一致
+        """
+        if self.store.contains(r, ss) if word_in else self.store.startswith(r, ss):
+            return True
+        return self.alias_index is not None and self.alias_index.match(r, ss, word_in)  # 別名が一致する
+
+    # ----------------------------------------------------------------------------------------
+    def search_kind(self, ss, word_in):
+        """
+        検索方法を返す
+        ss: 小文字化済みの検索文字列
+        word_in: Trueで部分一致、Falseで前方一致
+        """
+        if not word_in:
+            return 'prefix'  # 前方一致(インデックスを使用する)
+        elif self.ngram_index is not None and len(ss) >= NgramIndex.N:
+            return 'ngram'  # 部分一致(インデックスを使用する)
+        else:
+            return 'scan'  # 部分一致(連結した文字列を検索する)
+
+    # ----------------------------------------------------------------------------------------
+    def matches(self, ss, max_num, word_in):
+        """
+        (検索方法, 一致する候補の順位を元の順番で返すイテレータ)を返す
+        ss: 小文字化済みの検索文字列
+        max_num: 取得するデータの最大個数(検索方法の選択に使用する)
+        word_in: Trueで部分一致、Falseで前方一致
+        """
+        kind = self.search_kind(ss, word_in)
+        if kind == 'prefix':
+            matches = self.prefix_index.matches(ss, max_num)
+        elif kind == 'ngram':
+            matches = self.ngram_index.matches(ss)
+        else:
+            matches = self.store.matches(ss)
+        if self.alias_index is not None:
+            matches = merge_ranks(matches, self.alias_index.matches(ss, max_num, word_in))  # 別名が一致する候補を合わせる
+        return kind, matches
+
+    # ----------------------------------------------------------------------------------------
+    def cursor(self, prev, ss, max_num, word_in):
+        """
+        検索用のカーソルを返す(前回のカーソルが使える場合は絞り込んで再利用する)
+        prev: 前回の検索のカーソル(ない場合はNone)
+        ss: 小文字化済みの検索文字列
+        max_num: 取得するデータの最大個数
+        word_in: Trueで部分一致、Falseで前方一致
+        """
+        if prev is not None and prev.can_narrow(self, ss, word_in, self.search_kind(ss, word_in)):
+            prev.narrow(ss)
+            return prev
+
+        kind, matches = self.matches(ss, max_num, word_in)
+        return SuggestCursor(self, ss, word_in, kind, matches, self.search_size(kind, ss))
+
+    # ----------------------------------------------------------------------------------------
+    def search_size(self, kind, ss):
+        """
+        検索で確認する候補の数を返す('ngram'の時のみ。それ以外はNone)
+        kind: 検索方法
+        ss: 小文字化済みの検索文字列
+        """
+        if kind == 'ngram':
+            return len(self.ngram_index.shortest(ss))
+        return None
+
+    # ----------------------------------------------------------------------------------------
+    def merge_by_count(self, prefix_ranks, partial_ranks, ss, max_num):
+        """
+        前方一致と部分一致の候補を、重みを掛けた投稿数の順に並べて max_num 個を返す
+        前方一致の候補は投稿数順の上位 max_num 個、部分一致の候補は前方一致以外の候補を上位 max_num 個含むように渡す
+        (上位の候補はその中に必ず含まれる)
+        prefix_ranks: 前方一致の候補の順位
+        partial_ranks: 部分一致の候補の順位
+        ss: 小文字化済みの検索文字列
+        max_num: 取得するデータの最大個数
+        """
+        scores = {}
+        for r in prefix_ranks:
+            scores[r] = self.counts[r] * PREFIX_MATCH_WEIGHT
+        for r in partial_ranks:
+            if r not in scores:
+                weight = PREFIX_MATCH_WEIGHT if self.match(r, ss, False) else PARTIAL_MATCH_WEIGHT
+                scores[r] = self.counts[r] * weight
+        return sorted(scores, key=lambda r: (-scores[r], r))[:max_num]
+
+    # ----------------------------------------------------------------------------------------
+    def words(self, ranks):
+        """
+        順位の一覧を補完候補の文字列の一覧に変換する
+        ranks: 候補の順位の一覧
+        """
+        return [self.store.get(r) for r in ranks]
+
+    # ----------------------------------------------------------------------------------------
+    def find(self, word):
+        """
+        候補の順位を返す(存在しない場合は-1)
+        word: 候補の文字列
+        """
+        lw = word.lower()
+        order = self.prefix_index.order
+        p = self.prefix_index.bisect(lw)
+        while p < len(order) and self.store.lower(order[p]) == lw:
+            if self.store.get(order[p]) == word:
+                return order[p]
+            p += 1
+        return -1
+
+    # ----------------------------------------------------------------------------------------
+    def hot_ranks(self, hot_words, ss, word_in, max_num):
+        """
+        よく使う候補のうち、検索文字列に一致して一覧に存在するものの順位を返す
+        hot_words: よく使う候補の(小文字化した文字列, 文字列)のリスト(使用回数の多い順)
+        ss: 小文字化済みの検索文字列
+        word_in: Trueで部分一致、Falseで前方一致
+        max_num: 取得するデータの最大個数
+        """
+        ranks = []
+        for lw, w in hot_words:
+            if len(ranks) >= max_num:
+                break
+            if (ss in lw) if word_in else lw.startswith(ss):
+                r = self.find(w)  # 一覧から削除された候補は表示しない
+                if r != -1 and r not in ranks:
+                    ranks.append(r)
+        return ranks
+
+
+class AliasIndex(object):
+    """
+    別名(エイリアス)からタグを検索するためのインデックス
+    別名はタグの順位の順番に並べて保持し、別名の検索結果をタグの順位に変換して返す
+    """
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, data, owners, starts):
+        """
+        data: 別名の一覧と検索用のインデックス(SuggestData)
+        owners: 別名ごとのタグの順位の配列
+        starts: タグごとの別名の開始位置の配列(末尾に別名の個数を持つ)
+        """
+        self.data = data
+        self.owners = owners
+        self.starts = starts
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.data)
+
+    # ----------------------------------------------------------------------------------------
+    def dump(self):
+        """
+        キャッシュファイルに保存する内容を返す
+        """
+        data = self.data
+        return {
+            'store': data.store.dump(),
+            'prefix_index': data.prefix_index.dump(),
+            'ngram_index': data.ngram_index.dump() if data.ngram_index is not None else None,
+            'owners': self.owners.tostring(),
+            'starts': self.starts.tostring(),
+        }
+
+    # ----------------------------------------------------------------------------------------
+    @classmethod
+    def restore(cls, state):
+        """
+        キャッシュファイルの内容から作成する
+        state: dump() で作成したデータ
+        """
+        store = TagStore.restore(state['store'])
+        prefix_index = PrefixIndex.restore(store, state['prefix_index'])
+        ngram_index = NgramIndex.restore(store, state['ngram_index']) if state['ngram_index'] else None
+        return cls(SuggestData(store, prefix_index, ngram_index), array_from_bytes(state['owners']), array_from_bytes(state['starts']))
+
+    # ----------------------------------------------------------------------------------------
+    def match(self, r, ss, word_in):
+        """
+        タグの別名のいずれかが検索文字列に一致するかどうかを返す
+        r: タグの順位
+        ss: 小文字化済みの検索文字列
+        word_in: Trueで部分一致、Falseで前方一致
+        """
+        for i in range(self.starts[r], self.starts[r+1]):
+            if self.data.match(i, ss, word_in):
+                return True
+        return False
+
+    # ----------------------------------------------------------------------------------------
+    def matches(self, ss, max_num, word_in):
+        """
+        別名が一致するタグの順位を元の順番で返すイテレータ
+        ss: 小文字化済みの検索文字列
+        max_num: 取得するデータの最大個数(検索方法の選択に使用する)
+        word_in: Trueで部分一致、Falseで前方一致
+        """
+        kind, matches = self.data.matches(ss, max_num, word_in)
+        return (self.owners[i] for i in matches)  # 別名はタグの順番に並んでいるため、タグの順位も昇順になる
+
+
+def merge_ranks(*iterables):
+    """
+    順位の昇順のイテレータをまとめ、重複を除いて昇順で返すイテレータ
+    iterables: 順位の昇順のイテレータ
+    """
+    last = -1
+    for r in heapq.merge(*iterables):
+        if r != last:
+            last = r
+            yield r
 
 
 class TagManager(object):
     """
     タグファイル関連の操作を行なうクラス
     """
+    CACHE_EXT = '.cache'
+    CACHE_VERSION = 5  # キャッシュファイルの形式を変更した時は値を変える
+    MAX_COUNT = 2 ** 31 - 1
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self):
+        self.data = SuggestData(TagStore([]))
+        self.cursor = None  # 前回の検索のカーソル
+        self.prefix_cursor = None  # 投稿数順の時に部分一致と合わせて使用する前方一致のカーソル
+        self.fuzzy_cursor = None  # 前回のあいまい検索のカーソル
+        self.sources = {}  # タグファイルのパス -> (ファイルの状態, 読み込んだ行を圧縮したもの)
+        self.loaded_key = None  # 読み込んだ時のタグファイルの状態(読み込み前はNone)
+        self.active = True  # Falseにすると読み込みを途中で止める(スクリプトの終了時)
+
+    # ----------------------------------------------------------------------------------------
+    def load_tagfile(self, filepaths):
+        """
+        タグファイルを読み込み、1つのタグ一覧にまとめてインデックスを作成する
+        filepaths: タグファイルのパスのリスト(先頭のファイルほど優先する)
+        """
+        key = self.cache_key(filepaths)  # 読み込み中に更新された場合に備えて、読み込む前の状態を記録する
+        try:
+            return self.load_tagdata(filepaths)
+        finally:
+            self.loaded_key = key  # 読み込めなかった場合も、ファイルが更新されるまでは読み込み直さない
+
+    # ----------------------------------------------------------------------------------------
+    def is_modified(self, filepaths):
+        """
+        読み込んだ後でタグファイルが更新されたかどうかを返す(読み込み前はFalse)
+        filepaths: タグファイルのパスのリスト
+        """
+        return self.loaded_key is not None and self.cache_key(filepaths) != self.loaded_key
+
+    # ----------------------------------------------------------------------------------------
+    def load_tagdata(self, filepaths):
+        """
+        タグ一覧とインデックスを作成し、作成が終わったら丸ごと入れ替える
+        入れ替えるまでは古いデータで検索を続ける(前回の検索のカーソルは古いデータを参照しているため使用されなくなる)
+        filepaths: タグファイルのパスのリスト(先頭のファイルほど優先する)
+        """
+        data = self.load_cache(filepaths) if USE_TAG_CACHE else None
+        if data is not None:
+            self.data = data
+            return True
+
+        # 同じタグが複数のファイルにある場合は、優先度の高いファイルの行を使用する(1つのファイル内の重複はそのまま)
+        # ファイルごとの読み込み結果は、一部のファイルだけ更新された時のために複数のファイルがある場合だけ残す
+        keep_source = len(filepaths) > 1
+        if not keep_source:
+            self.sources.clear()
+        rows = []
+        seen = set()
+        loaded = False
+        for i in range(len(filepaths)):
+            if not self.active:
+                return False  # スクリプトが終了された
+            source_rows = self.read_tagfile(filepaths[i], keep_source)
+            if source_rows is None:
+                continue
+            loaded = True
+            if seen:
+                rows.extend([row for row in source_rows if row[0].lower() not in seen])
+            else:
+                rows.extend(source_rows)
+            if i < len(filepaths) - 1:  # 最後のファイルのタグは以降のファイルと比べないため覚えない
+                seen.update([row[0].lower() for row in source_rows])
+        if not loaded or not self.active:
+            return False
+
+        # インデックスの作成は時間がかかるため、作成の合間にもスクリプトが終了されていないか確認する
+        try:
+            if RANK_BY_COUNT:
+                rows.sort(key=lambda row: -row[1])  # 投稿数の多い順に並べる(投稿数が同じ場合はファイルの順番)
+                counts = array('i', [row[1] for row in rows])
+            else:
+                counts = None
+            store = TagStore([row[0] for row in rows])  # 連結した文字列として保持する
+            fuzzy_index = FuzzyIndex(store, FUZZY_MAX_DISTANCE, FUZZY_PREFIX_LENGTH) if FUZZY_MAX_DISTANCE > 0 else None
+            ngram_index = self.build_ngram_index(store, NGRAM_INDEX_MAX_MB)
+            if not self.active:
+                return False
+            if USE_TAG_ALIAS:
+                # 別名のN-gramインデックスは、タグのインデックスの残りのメモリで作成する(合わせて NGRAM_INDEX_MAX_MB 以下にする)
+                ngram_mb = NgramIndex.estimate_mb(store) if ngram_index is not None else 0
+                alias_index = self.build_alias_index([row[2] for row in rows], NGRAM_INDEX_MAX_MB - ngram_mb)
+            else:
+                alias_index = None
+            data = SuggestData(store, PrefixIndex(store), ngram_index, counts, fuzzy_index, alias_index)  # 検索用のインデックスを作成する
+        except Exception as e:
+            console.write("Error building tag index: {}\n".format(e))
+            return False
+        if USE_TAG_CACHE:
+            self.save_cache(filepaths, data)
+        self.data = data  # 作成したデータに入れ替える
+        return True
+
+    # ----------------------------------------------------------------------------------------
+    def read_tagfile(self, filepath, keep_source=False):
+        """
+        タグファイルの各行を(タグ, 投稿数, 別名のリスト)のリストにして返す(読み込めない場合はNone)
+        前回読み込んだ時からファイルが変わっていない場合は読み込み直さない
+        filepath: タグファイルのパス
+        keep_source: 読み込んだ行を次回のために残すかどうか
+        """
+        try:
+            stat = self.file_stat(filepath)
+            source = self.sources.get(filepath)
+            if source is not None and source[0] == stat:
+                try:
+                    return self.unpack_rows(source[1])
+                except Exception:
+                    pass  # 壊れている場合は読み直す
+
+            rows = []
+            with open(filepath, 'r') as f:
+                reader = csv.reader(f)
+                for row in reader:
+                    if row and row[0].strip():  # 行が空でなく、かつ最初の列に値がある場合のみ処理
+                        tag = row[0].strip().decode('utf-8').replace(TagStore.SEP, u' ')  # UTF-8にデコードしてPythonのユニコード文字列として扱う
+                        rows.append((tag, self.parse_count(row) if RANK_BY_COUNT else 0, self.parse_aliases(row, tag) if USE_TAG_ALIAS else []))
+            if keep_source:
+                self.sources[filepath] = (stat, self.pack_rows(rows))
+            return rows
+
+        except (IOError, OSError):
+            # ファイルが存在しない場合は、コンソールにメッセージを表示するだけ
+            console.write("Info: {} not found. Skipping.\n".format(os.path.basename(filepath)))
+        except Exception as e:
+            # その他のエラーが発生した場合
+            console.write("Error reading {}: {}\n".format(os.path.basename(filepath), e))
+        self.sources.pop(filepath, None)
+        return None
+
+    # ----------------------------------------------------------------------------------------
+    def pack_rows(self, rows):
+        """
+        読み込んだ行を、行ごとにオブジェクトを持たない形(連結した文字列と配列)にして返す
+        rows: (タグ, 投稿数, 別名のリスト)のリスト
+        """
+        return (len(rows),
+                TagStore.SEP.join([row[0] for row in rows]),
+                array('i', [row[1] for row in rows]).tostring(),
+                TagStore.SEP.join([u','.join(row[2]) for row in rows]))
 
     # ----------------------------------------------------------------------------------------
-    def __init__(self):
-        self.tags = []
+    def unpack_rows(self, packed):
+        """
+        pack_rows() で作成したデータから行のリストを返す
+        packed: pack_rows() で作成したデータ
+        """
+        num, tags, counts, aliases = packed
+        if num == 0:
+            return []
+        tags = tags.split(TagStore.SEP)
+        counts = array_from_bytes(counts)
+        aliases = [a.split(u',') if a else [] for a in aliases.split(TagStore.SEP)]
+        if not (len(tags) == len(counts) == len(aliases) == num):
+            raise ValueError('packed rows size mismatch')
+        return list(zip(tags, counts, aliases))
 
     # ----------------------------------------------------------------------------------------
-    def load_tagfile(self, filepath):
+    def parse_count(self, row):
         """
-        タグファイルを読み込む
-        filepath: タグファイルのパス
+        CSVファイルの行から投稿数を取得する(取得できない場合は0)
+        row: CSVファイルの行
         """
-        self.tags = []
         try:
-            with open(filepath, 'r') as f:
-                reader = csv.reader(f)
-                for row in reader:
-                    if row and row[0].strip():  # 行が空でなく、かつ最初の列に値がある場合のみ処理
-                        self.tags.append(row[0].strip().decode('utf-8'))  # UTF-8にデコードしてPythonのユニコード文字列として扱う
-            return True
+            return min(max(int(row[TAG_COUNT_COLUMN].strip()), 0), self.MAX_COUNT)
+        except (IndexError, ValueError):
+            return 0
 
-        except IOError:
-            # ファイルが存在しない場合は、コンソールにメッセージを表示するだけ
-            console.write("Info: {} not found. Skipping.\n".format(os.path.basename(filepath)))
+    # ----------------------------------------------------------------------------------------
+    def parse_aliases(self, row, tag):
+        """
+        CSVファイルの行から別名の一覧を取得する
+        row: CSVファイルの行
+        tag: タグ(小文字化して同じになる別名は除く)
+        """
+        if len(row) <= TAG_ALIAS_COLUMN:
+            return []
+        aliases = []
+        seen = set([tag.lower()])
+        for alias in row[TAG_ALIAS_COLUMN].split(','):
+            alias = alias.strip().decode('utf-8').replace(TagStore.SEP, u' ')
+            if alias and alias.lower() not in seen:
+                seen.add(alias.lower())
+                aliases.append(alias)
+        return aliases
+
+    # ----------------------------------------------------------------------------------------
+    def build_alias_index(self, alias_lists, ngram_max_mb):
+        """
+        別名検索用のインデックスを作成する(別名がない場合はNoneを返す)
+        alias_lists: タグの順位の順番に並べた、タグごとの別名のリスト
+        ngram_max_mb: 別名のN-gramインデックスに使用するメモリの上限(MB)
+        """
+        aliases = []
+        owners = array('i')
+        starts = array('i', [0])
+        for r, alias_list in enumerate(alias_lists):
+            aliases.extend(alias_list)
+            owners.extend([r] * len(alias_list))
+            starts.append(len(aliases))
+        if not aliases:
+            return None
+        store = TagStore(aliases)
+        return AliasIndex(SuggestData(store, PrefixIndex(store), self.build_ngram_index(store, ngram_max_mb, 'Alias N-gram index')), owners, starts)
+
+    # ----------------------------------------------------------------------------------------
+    def file_stat(self, filepath):
+        """
+        ファイルが更新されたかどうかを判定するための値を返す
+        filepath: ファイルのパス
+        """
+        st = os.stat(filepath)
+        return (st.st_size, st.st_mtime)
+
+    # ----------------------------------------------------------------------------------------
+    def cache_key(self, filepaths):
+        """
+        キャッシュファイルが有効かどうかを判定するための値を返す
+        filepaths: タグファイルのパスのリスト
+        """
+        stats = []
+        for filepath in filepaths:
+            try:
+                stats.append((os.path.basename(filepath), self.file_stat(filepath)))
+            except OSError:
+                stats.append((os.path.basename(filepath), None))  # 存在しないファイル
+        return (self.CACHE_VERSION, tuple(stats), array('i').itemsize, NGRAM_INDEX_MAX_MB,
+                RANK_BY_COUNT, TAG_COUNT_COLUMN, FUZZY_MAX_DISTANCE, FUZZY_PREFIX_LENGTH, USE_TAG_ALIAS, TAG_ALIAS_COLUMN)
+
+    # ----------------------------------------------------------------------------------------
+    def load_cache(self, filepaths):
+        """
+        キャッシュファイルからタグ一覧とインデックスを読み込む(読み込めない場合はNoneを返す)
+        filepaths: タグファイルのパスのリスト(キャッシュファイルは先頭のファイルの名前で作成する)
+        """
+        cachepath = filepaths[0] + self.CACHE_EXT
+        try:
+            key = self.cache_key(filepaths)
+            with open(cachepath, 'rb') as f:
+                cache = marshal.loads(f.read())  # まとめて読み込む
+            if cache[0][:1] + cache[0][2:] != key[:1] + key[2:]:
+                return None  # 設定が変わっている
+            state = cache[1]
+            # ファイルごとの読み込み結果を戻しておく(一部のファイルだけ更新された時に他のファイルを読み直さない)
+            self.sources.update(dict([(filepath, (tuple(source[0]), source[1])) for filepath, source in state['sources'].items()]))
+            if cache[0] != key:
+                return None  # タグファイルが更新されている
+
+            store = TagStore.restore(state['store'])
+            prefix_index = PrefixIndex.restore(store, state['prefix_index'])
+            ngram_index = NgramIndex.restore(store, state['ngram_index']) if state['ngram_index'] else None
+            counts = array_from_bytes(state['counts']) if state['counts'] is not None else None
+            fuzzy_index = FuzzyIndex.restore(store, state['fuzzy_index']) if state['fuzzy_index'] else None
+            alias_index = AliasIndex.restore(state['alias_index']) if state['alias_index'] else None
+            if alias_index is not None and len(alias_index.starts) != len(store) + 1:
+                raise ValueError('alias index size mismatch')
+            if len(prefix_index.order) != len(store) or (counts is not None and len(counts) != len(store)):
+                raise ValueError('index size mismatch')
+            return SuggestData(store, prefix_index, ngram_index, counts, fuzzy_index, alias_index)
+
+        except (IOError, OSError):
+            pass  # キャッシュファイルが存在しない
         except Exception as e:
-            # その他のエラーが発生した場合
-            console.write("Error reading {}: {}\n".format(os.path.basename(filepath), e))
-        return False
+            # キャッシュファイルが壊れている場合は作り直す
+            console.write("Info: {} is broken ({}). Rebuilding.\n".format(os.path.basename(cachepath), e))
+        return None
+
+    # ----------------------------------------------------------------------------------------
+    def save_cache(self, filepaths, data):
+        """
+        タグ一覧とインデックスをキャッシュファイルに保存する
+        filepaths: タグファイルのパスのリスト
+        data: 保存するSuggestData
+        """
+        cachepath = filepaths[0] + self.CACHE_EXT
+        state = {
+            'store': data.store.dump(),
+            'prefix_index': data.prefix_index.dump(),
+            'ngram_index': data.ngram_index.dump() if data.ngram_index is not None else None,
+            'counts': data.counts.tostring() if data.counts is not None else None,
+            'fuzzy_index': data.fuzzy_index.dump() if data.fuzzy_index is not None else None,
+            'alias_index': data.alias_index.dump() if data.alias_index is not None else None,
+            'sources': dict([(filepath, self.sources[filepath]) for filepath in filepaths if filepath in self.sources]),
+        }
+        try:
+            # 書き込み途中のファイルを読み込まないように、一時ファイルに書き込んでから置き換える
+            with open(cachepath + '.tmp', 'wb') as f:
+                f.write(marshal.dumps((self.cache_key(filepaths), state), 2))
+            if os.path.exists(cachepath):
+                os.remove(cachepath)
+            os.rename(cachepath + '.tmp', cachepath)
+        except (IOError, OSError) as e:
+            console.write("Info: Could not write {} ({}).\n".format(os.path.basename(cachepath), e))
+
+    # ----------------------------------------------------------------------------------------
+    def build_ngram_index(self, store, max_mb, name='N-gram index'):
+        """
+        部分一致検索用のインデックスを作成する(メモリの上限を超える場合はNoneを返す)
+        store: タグ一覧のTagStore
+        max_mb: インデックスに使用するメモリの上限(MB)
+        name: 上限を超えた時に表示するインデックスの名前
+        """
+        if max_mb <= 0:
+            return None
+        size = NgramIndex.estimate_mb(store)
+        if size > max_mb:
+            console.write("Info: {} ({:.1f} MB) exceeds NGRAM_INDEX_MAX_MB. Skipping.\n".format(name, size))
+            return None
+        return NgramIndex(store)
 
     # ----------------------------------------------------------------------------------------
-    def tag_suggest(self, s, max_num, word_in):
+    def tag_suggest(self, s, max_num, word_in, hot_words=None):
         """
         タグの補完候補一覧を返す
         s: 補完候補の取得に使用する文字列
         max_num: 取得するデータの最大個数
         word_in: Trueで部分一致、Falseで前方一致
+        hot_words: よく使う候補のリスト(先頭に表示する。Noneの時は使用しない)
         """
-
-        suggestions = []
         ss = s.decode('utf-8').lower()
-        for word in self.tags:
-            if len(suggestions) >= max_num:
-                break
-
-            if OPT_WORD_IN: # 部分一致
-                if ss in word.lower():
-                    suggestions.append(word)
-            else: # 前方一致
-                if word.lower().startswith(ss):
-                    suggestions.append(word)
+        data = self.data
+        hot = data.hot_ranks(hot_words, ss, word_in, HISTORY_SHOW_WORDS) if hot_words else []  # よく使う候補を先に探す
+        self.cursor = data.cursor(self.cursor, ss, max_num, word_in)  # 前回の検索結果を再利用できる時は絞り込む
+        if data.counts is None or not word_in:
+            ranks = self.cursor.take(max_num)
+        else:
+            # 投稿数順の部分一致検索では、前方一致の候補と部分一致の候補を重みを付けて並べる
+            # (順位が投稿数順なので、それぞれ先頭の max_num 個だけを比べればよい)
+            self.prefix_cursor = data.cursor(self.prefix_cursor, ss, max_num, False)
+            ranks = data.merge_by_count(self.prefix_cursor.take(max_num), self.take_partial(data, ss, max_num), ss, max_num)
+        if hot:
+            ranks = (hot + [r for r in ranks if r not in hot])[:max_num]
+
+        # 完全一致の候補が足りない時は、あいまい検索の候補を追加する
+        if len(ranks) < max_num and data.fuzzy_index is not None and len(ss) >= data.fuzzy_index.prefix_len:
+            self.fuzzy_cursor = data.fuzzy_index.cursor(self.fuzzy_cursor, ss)
+            ranks = ranks + self.fuzzy_cursor.take(max_num - len(ranks), set(ranks))
+        return data.words(ranks)
 
-        return suggestions
+    # ----------------------------------------------------------------------------------------
+    def take_partial(self, data, ss, max_num):
+        """
+        投稿数順の部分一致の候補を、重みを付けて並べるのに必要な数だけ返す
+        部分一致の重みが前方一致の重み以下の時は先頭の max_num 個で足りるが、
+        部分一致の重みの方が大きい時は、前方一致の候補を除いて max_num 個になるまで取得する
+        data: 検索対象のSuggestData
+        ss: 小文字化済みの検索文字列
+        max_num: 取得するデータの最大個数
+        """
+        num = max_num
+        while True:
+            ranks = self.cursor.take(num)
+            if PARTIAL_MATCH_WEIGHT <= PREFIX_MATCH_WEIGHT or len(ranks) < num:
+                return ranks
+            if len([r for r in ranks if not data.match(r, ss, False)]) >= max_num:
+                return ranks
+            num += max_num
 
     def get_tag_num(self):
         """
         タグの個数を返す
         """
-        return len(self.tags)
+        return len(self.data)
+
+
+class DirScanner(object):
+    """
+    ディレクトリ以下のディレクトリ、ファイルの一覧を取得するクラス
+    ディレクトリごとに更新日時を記録し、再スキャン時は更新日時が変わったディレクトリだけを読み直す
+    """
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, root, ext):
+        """
+        root: スキャンするディレクトリのパス
+        ext: 一覧に含めるファイルの拡張子
+        """
+        self.root = root
+        self.ext = ext
+        self.dirs = {}  # 相対パス('/'区切り) -> (更新日時, サブディレクトリ名のセット, ファイル名のセット)
+
+    # ----------------------------------------------------------------------------------------
+    def join(self, rel, name):
+        """
+        相対パスに名前を連結する
+        """
+        return rel + u'/' + name if rel else name
+
+    # ----------------------------------------------------------------------------------------
+    def read_dir(self, rel):
+        """
+        ディレクトリの更新日時と、直下のサブディレクトリ名、ファイル名を取得する
+        rel: ディレクトリの相対パス
+        """
+        path = os.path.join(self.root, *rel.split(u'/')) if rel else self.root
+        mtime = os.stat(path).st_mtime  # 一覧を取得する前に更新日時を取得する(取得中の変更を見逃さない)
+        subdirs = set()
+        files = set()
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)):
+                subdirs.add(name)
+            elif name.endswith(self.ext):
+                files.add(name)
+        return mtime, subdirs, files
+
+    # ----------------------------------------------------------------------------------------
+    def scan_tree(self, rel, dirs, files):
+        """
+        ディレクトリ以下を全てスキャンする
+        rel: ディレクトリの相対パス
+        dirs: 見つかったディレクトリの相対パスを追加するリスト
+        files: 見つかったファイルの相対パスを追加するリスト
+        """
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            try:
+                entry = self.dirs[rel] = self.read_dir(rel)
+            except OSError:
+                continue  # スキャン中に削除された
+            dirs.append(rel)
+            files.extend([self.join(rel, f) for f in entry[2]])
+            stack.extend([self.join(rel, d) for d in entry[1]])
+
+    # ----------------------------------------------------------------------------------------
+    def remove_tree(self, rel, dirs, files):
+        """
+        ディレクトリ以下を一覧から削除する
+        rel: ディレクトリの相対パス
+        dirs: 削除したディレクトリの相対パスを追加するリスト
+        files: 削除したファイルの相対パスを追加するリスト
+        """
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            entry = self.dirs.pop(rel, None)
+            if entry is None:
+                continue
+            dirs.append(rel)
+            files.extend([self.join(rel, f) for f in entry[2]])
+            stack.extend([self.join(rel, d) for d in entry[1]])
+
+    # ----------------------------------------------------------------------------------------
+    def scan(self):
+        """
+        全てのディレクトリをスキャンし、(ディレクトリ一覧, ファイル一覧)を返す
+        """
+        self.dirs = {}
+        dirs = []
+        files = []
+        self.scan_tree(u'', dirs, files)
+        return dirs, files
+
+    # ----------------------------------------------------------------------------------------
+    def rescan(self):
+        """
+        更新日時が変わったディレクトリだけを読み直し、
+        (追加されたディレクトリ, 追加されたファイル, 削除されたディレクトリ, 削除されたファイル)を返す
+        """
+        added_dirs, added_files, removed_dirs, removed_files = [], [], [], []
+        for rel in list(self.dirs):
+            old = self.dirs.get(rel)
+            if old is None:
+                continue  # 親ディレクトリと一緒に削除済み
+            try:
+                if os.stat(os.path.join(self.root, *rel.split(u'/')) if rel else self.root).st_mtime == old[0]:
+                    continue  # 変更なし
+                entry = self.dirs[rel] = self.read_dir(rel)
+            except OSError:
+                self.remove_tree(rel, removed_dirs, removed_files)  # ディレクトリが削除された
+                continue
+
+            added_files.extend([self.join(rel, f) for f in entry[2] - old[2]])
+            removed_files.extend([self.join(rel, f) for f in old[2] - entry[2]])
+            for d in old[1] - entry[1]:
+                self.remove_tree(self.join(rel, d), removed_dirs, removed_files)
+            for d in entry[1] - old[1]:
+                self.scan_tree(self.join(rel, d), added_dirs, added_files)
+        return added_dirs, added_files, removed_dirs, removed_files
 
 
 class WildcardManager(object):
@@ -141,9 +1440,11 @@ class WildcardManager(object):
 
     # ----------------------------------------------------------------------------------------
     def __init__(self):
-        self.dir_list = []
-        self.txt_list = []  # *.txt (not support yaml)
+        self.scanner = None  # *.txtの一覧を取得するDirScanner (not support yaml)
+        self.dir_set = set()
         self.suggest_list = []
+        self.data = SuggestData(TagStore([]))
+        self.cursor = None  # 前回の検索のカーソル
 
     # ----------------------------------------------------------------------------------------
     def load_wildcards(self, d):
@@ -153,44 +1454,57 @@ class WildcardManager(object):
         """
         if not os.path.exists(d):
             return False
-        self.dir_list = []
-        self.txt_list = []
-        self.suggest_list = []
+        scanner = DirScanner(d.decode('utf-8'), '.txt')  # 非ASCII文字を含むファイル名に備えてユニコード文字列で扱う
 
         # ディレクトリとファイルのリストを取得する
-        d_len = len(d) if d.endswith('\\') else len(d) + 1
-        for dirpath, dirname, files in os.walk(d):
-            self.dir_list.append(dirpath[d_len:].replace('\\','/'))  # ディレクトリパスを整形してリストに追加
-            for file in files:
-                if file.endswith('.txt'):
-                    s = os.path.join(dirpath,file)
-                    self.txt_list.append(s[d_len:].replace('\\','/').replace('.txt',''))  # ファイルパスを整形してリストに追加
-        self.suggest_list = sorted(list(filter(None, self.dir_list + self.txt_list)))
+        dir_list, txt_list = scanner.scan()
+        suggest_list = sorted(list(filter(None, dir_list + [f.replace('.txt','') for f in txt_list])))
+        data = SuggestData(TagStore(suggest_list))  # 前方一致検索用のインデックスを作成する
+
+        # 作成したリストに入れ替える
+        self.scanner = scanner
+        self.dir_set = set(dir_list)
+        self.suggest_list = suggest_list
+        self.data = data
+
+        return True
+
+    # ----------------------------------------------------------------------------------------
+    def rescan_wildcards(self):
+        """
+        変更されたディレクトリだけを読み直して一覧を更新する(変更がない場合はFalseを返す)
+        """
+        if self.scanner is None:
+            return False  # 読み込みが終わっていない
+        added_dirs, added_files, removed_dirs, removed_files = self.scanner.rescan()
+        if not (added_dirs or added_files or removed_dirs or removed_files):
+            return False
 
+        patch_sorted_list(self.suggest_list,
+                          filter(None, added_dirs + [f.replace('.txt','') for f in added_files]),
+                          filter(None, removed_dirs + [f.replace('.txt','') for f in removed_files]))
+        dir_set = (self.dir_set - set(removed_dirs)) | set(added_dirs)
+        data = SuggestData(TagStore(self.suggest_list))
+
+        # 作成したリストに入れ替える
+        self.dir_set = dir_set
+        self.data = data
         return True
 
     # ----------------------------------------------------------------------------------------
-    def wildcard_suggest(self, s, max_num, word_in):
+    def wildcard_suggest(self, s, max_num, word_in, hot_words=None):
         """
         wildcardの補完候補一覧を返す
         s: 補完候補の取得に使用する文字列
         max_num: 取得するデータの最大個数
         word_in: Trueで部分一致、Falseで前方一致
+        hot_words: よく使う候補のリスト(先頭に表示する。Noneの時は使用しない)
         """
-        suggestions = []
         ss = s[2:].decode('utf-8').lower()  # 検索文字列の整形(先頭の__を削る、小文字化)
-        for word in self.suggest_list:
-            if len(suggestions) >= max_num:
-                break
-
-            if word_in:
-                if ss in word.lower():
-                    suggestions.append(word)  # 部分一致した候補をリストに追加
-            else:
-                if word.lower().startswith(ss):
-                    suggestions.append(word)  # 前方一致した候補をリストに追加
-
-        return suggestions
+        data = self.data
+        hot = data.hot_ranks(hot_words, ss, word_in, HISTORY_SHOW_WORDS) if hot_words else []  # よく使う候補を先に探す
+        self.cursor = data.cursor(self.cursor, ss, max_num, word_in)  # 前回の検索結果を再利用できる時は絞り込む
+        return data.words((hot + [r for r in self.cursor.take(max_num) if r not in hot])[:max_num])
 
     # ----------------------------------------------------------------------------------------
     def item_is_dir(self, s):
@@ -198,25 +1512,38 @@ class WildcardManager(object):
         候補がディレクトリかファイルかを判別する
         s: 調査する候補
         """
-        return s in self.dir_list
+        return s.decode('utf-8') in self.dir_set
 
     # ----------------------------------------------------------------------------------------
     def get_wildcard_num(self):
         """
         ワイルドカードの個数(ディレクトリとファイルの数)を返す
         """
-        return len(self.suggest_list)
+        return len(self.data)
 
 
 class LoraManager(object):
     """
     Lora関連の操作を行なうクラス
     """
+    CACHE_VERSION = 1  # キャッシュファイルの形式を変更した時は値を変える
+    MAX_HEADER_SIZE = 100 * 1024 * 1024  # これより大きいヘッダーは壊れたファイルとして扱う
+    MAX_TRIGGER_WORDS = 100  # Loraごとに保持するトリガーワードの最大数
 
     # ----------------------------------------------------------------------------------------
-    def __init__(self):
-        self.lorafile_list = []  # *.safetensors or *.pt
+    def __init__(self, cachefile=None):
+        """
+        cachefile: トリガーワードの読み込み結果を保存するファイルのパス(Noneの時は保存しない)
+        """
+        self.scanner = None  # *.safetensorsの一覧を取得するDirScanner
         self.suggest_list = []
+        self.data = SuggestData(TagStore([]))
+        self.cursor = None  # 前回の検索のカーソル
+        self.cachefile = cachefile
+        self.trigger_lock = threading.Lock()  # 先読みのスレッドと、Lora補完後の読み込みのスレッドから使用する
+        self.triggers = {}  # Loraファイルのパス -> (ファイルの状態, トリガーワードのリスト)
+        self.triggers_modified = False  # キャッシュファイルに保存していない読み込み結果がある
+        self.active = True  # Falseにすると先読みを途中で止める(スクリプトの終了時)
 
     # ----------------------------------------------------------------------------------------
     def load_loras(self, d):
@@ -226,49 +1553,406 @@ class LoraManager(object):
         """
         if not os.path.exists(d):
             return False
-        self.lorafile_list = []
-        self.suggest_list = []
+        scanner = DirScanner(d.decode('utf-8'), '.safetensors')  # 非ASCII文字を含むファイル名に備えてユニコード文字列で扱う
 
         # ディレクトリとファイルのリストを取得する
-        d_len = len(d) if d.endswith('\\') else len(d) + 1
-        for dirpath, dirname, files in os.walk(d):
-            for file in files:
-                if file.endswith('.safetensors'):
-                    s = os.path.join(dirpath,file)
-                    self.lorafile_list.append(s[d_len:].replace('\\','/').replace('.safetensors',''))  # ファイルパスを整形してリストに追加
-        self.suggest_list = sorted(list(filter(None, self.lorafile_list)))
+        dir_list, lorafile_list = scanner.scan()
+        suggest_list = sorted(list(filter(None, [f.replace('.safetensors','') for f in lorafile_list])))
+        data = SuggestData(TagStore(suggest_list))  # 前方一致検索用のインデックスを作成する
+
+        # 作成したリストに入れ替える
+        self.scanner = scanner
+        self.suggest_list = suggest_list
+        self.data = data
 
         return True
 
     # ----------------------------------------------------------------------------------------
-    def lora_suggest(self, s, max_num, word_in):
+    def rescan_loras(self):
         """
-        wildcardの補完候補一覧を返す
+        変更されたディレクトリだけを読み直して一覧を更新する(変更がない場合はFalseを返す)
+        """
+        if self.scanner is None:
+            return False  # 読み込みが終わっていない
+        added_dirs, added_files, removed_dirs, removed_files = self.scanner.rescan()
+        if not (added_files or removed_files):
+            return False
+
+        patch_sorted_list(self.suggest_list,
+                          filter(None, [f.replace('.safetensors','') for f in added_files]),
+                          filter(None, [f.replace('.safetensors','') for f in removed_files]))
+        self.data = SuggestData(TagStore(self.suggest_list))  # 作成したデータに入れ替える
+        return True
+
+    # ----------------------------------------------------------------------------------------
+    def lora_suggest(self, s, max_num, word_in, hot_words=None):
+        """
+        Loraの補完候補一覧を返す
         s: 補完候補の取得に使用する文字列
         max_num: 取得するデータの最大個数
         word_in: Trueで部分一致、Falseで前方一致
+        hot_words: よく使う候補のリスト(先頭に表示する。Noneの時は使用しない)
         """
-        suggestions = []
         ss = s[4:].decode('utf-8').lower()  # 検索文字列の整形(先頭の____を削る、小文字化)
-        for word in self.suggest_list:
-            if len(suggestions) >= max_num:
-                break
-
-            if word_in:
-                if ss in word.lower():
-                    suggestions.append(word)  # 部分一致した候補をリストに追加
-            else:
-                if word.lower().startswith(ss):
-                    suggestions.append(word)  # 前方一致した候補をリストに追加
-
-        return suggestions
+        data = self.data
+        hot = data.hot_ranks(hot_words, ss, word_in, HISTORY_SHOW_WORDS) if hot_words else []  # よく使う候補を先に探す
+        self.cursor = data.cursor(self.cursor, ss, max_num, word_in)  # 前回の検索結果を再利用できる時は絞り込む
+        return data.words((hot + [r for r in self.cursor.take(max_num) if r not in hot])[:max_num])
 
     # ----------------------------------------------------------------------------------------
     def get_loras_num(self):
         """
         Loraファイルの個数を返す
         """
-        return len(self.suggest_list)
+        return len(self.data)
+
+    # ----------------------------------------------------------------------------------------
+    def lora_path(self, s):
+        """
+        補完候補の文字列からLoraファイルのパスを返す
+        s: 補完候補の文字列(Loraディレクトリからの相対パス、拡張子なし)
+        """
+        return os.path.join(self.scanner.root, *(s + '.safetensors').split('/'))
+
+    # ----------------------------------------------------------------------------------------
+    def trigger_words(self, s):
+        """
+        Loraのトリガーワードのリストを返す(読み込み結果がない時や、ファイルが更新されている時は読み込む)
+        s: 補完候補の文字列
+        """
+        if self.scanner is None:
+            return []
+        path = self.lora_path(s)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return []  # 削除されたファイル
+        stat = (st.st_size, st.st_mtime)
+        with self.trigger_lock:
+            cached = self.triggers.get(path)
+        if cached is not None and cached[0] == stat:
+            return cached[1]
+
+        words = self.read_trigger_words(path)
+        with self.trigger_lock:
+            self.triggers[path] = (stat, words)
+            self.triggers_modified = True
+        return words
+
+    # ----------------------------------------------------------------------------------------
+    def read_trigger_words(self, path):
+        """
+        safetensorsファイルのヘッダーを読み込み、学習に使われたタグを多い順に返す
+        ヘッダーはファイルの先頭にあり、8バイトのヘッダーの長さ(リトルエンディアン)と、JSON形式のヘッダーが続く
+        path: Loraファイルのパス
+        """
+        try:
+            with open(path, 'rb') as f:
+                size = struct.unpack('<Q', f.read(8))[0]
+                if size > self.MAX_HEADER_SIZE:
+                    return []
+                header = json.loads(f.read(size).decode('utf-8'))
+        except (IOError, OSError, struct.error, ValueError):
+            return []  # 読み込めないファイル、safetensors形式ではないファイル
+        metadata = header.get('__metadata__') if isinstance(header, dict) else None
+        if not isinstance(metadata, dict):
+            return []  # メタデータがないファイル、形式が違うファイル
+
+        words = []
+        seen = set()
+        # トリガーワードが指定されている場合は先頭に置く
+        phrase = metadata.get('modelspec.trigger_phrase')
+        for word in (phrase if isinstance(phrase, basestring) else u'').split(u','):
+            word = word.strip()
+            if word and word.lower() not in seen:
+                seen.add(word.lower())
+                words.append(word)
+        # 学習に使われたタグの数を合計する(データセットごとに {タグ: 数} の形式)
+        counts = {}
+        try:
+            for freq in json.loads(metadata.get('ss_tag_frequency') or u'{}').values():
+                for tag, count in freq.items():
+                    tag = tag.strip()
+                    counts[tag] = counts.get(tag, 0) + int(count)
+        except (AttributeError, TypeError, ValueError):
+            pass  # 形式が違う
+        for tag, count in sorted(counts.items(), key=lambda item: -item[1]):
+            if tag and u',' not in tag and tag.lower() not in seen:  # カンマはメニューの区切り文字のため除く
+                seen.add(tag.lower())
+                words.append(tag)
+        return words[:self.MAX_TRIGGER_WORDS]
+
+    # ----------------------------------------------------------------------------------------
+    def preload_triggers(self):
+        """
+        全てのLoraのトリガーワードを先に読み込み、キャッシュファイルに保存する(別スレッドで実行する)
+        削除されたLoraの読み込み結果は捨てる
+        """
+        suggest_list = list(self.suggest_list)
+        for s in suggest_list:
+            if not self.active:
+                return  # スクリプトが終了された(次に実行したスクリプトがキャッシュファイルを保存する)
+            try:
+                self.trigger_words(s)
+            except Exception as e:
+                # 1つのファイルで失敗しても他のファイルの読み込みと保存は続ける
+                console.write("Error reading trigger words of {}: {}\n".format(s.encode('utf-8'), e))
+        paths = set([self.lora_path(s) for s in suggest_list])
+        with self.trigger_lock:
+            for path in [path for path in self.triggers if path not in paths]:
+                del self.triggers[path]
+                self.triggers_modified = True
+        self.save_trigger_cache()
+
+    # ----------------------------------------------------------------------------------------
+    def load_trigger_cache(self):
+        """
+        キャッシュファイルからトリガーワードの読み込み結果を読み込む
+        """
+        if self.cachefile is None:
+            return
+        try:
+            with open(self.cachefile, 'rb') as f:
+                cache = marshal.loads(f.read())
+            if cache[0] != self.CACHE_VERSION:
+                return
+            triggers = dict([(path, (tuple(stat), list(words))) for path, (stat, words) in cache[1].items()])
+        except (IOError, OSError):
+            return  # キャッシュファイルが存在しない
+        except Exception as e:
+            console.write("Info: {} is broken ({}). Rebuilding.\n".format(os.path.basename(self.cachefile), e))
+            return
+        with self.trigger_lock:
+            for path, trigger in triggers.items():
+                self.triggers.setdefault(path, trigger)
+
+    # ----------------------------------------------------------------------------------------
+    def save_trigger_cache(self):
+        """
+        トリガーワードの読み込み結果をキャッシュファイルに保存する(読み込み結果が増えていない時は保存しない)
+        """
+        if self.cachefile is None:
+            return
+        with self.trigger_lock:
+            if not self.triggers_modified:
+                return
+            triggers = dict([(path, (stat, tuple(words))) for path, (stat, words) in self.triggers.items()])
+            self.triggers_modified = False
+        try:
+            # 書き込み途中のファイルを読み込まないように、一時ファイルに書き込んでから置き換える
+            with open(self.cachefile + '.tmp', 'wb') as f:
+                f.write(marshal.dumps((self.CACHE_VERSION, triggers), 2))
+            if os.path.exists(self.cachefile):
+                os.remove(self.cachefile)
+            os.rename(self.cachefile + '.tmp', self.cachefile)
+        except (IOError, OSError) as e:
+            console.write("Info: Could not write {} ({}).\n".format(os.path.basename(self.cachefile), e))
+
+
+
+class UsageHistory(object):
+    """
+    メニューから選択した回数を記録するクラス
+    選択するたびにログファイルに追記し、起動時と定期的にログの内容を回数のファイルにまとめる
+    補完の種類('tag', 'wildcard', 'lora')ごとに、選択回数の多い候補(よく使う候補)の一覧を持つ
+    """
+    LOG_EXT = '.log'
+    HOT_SIZE = 200  # よく使う候補として扱う候補の数(補完の種類ごと)
+    MAX_ENTRIES = 5000  # 回数のファイルに保存する候補の最大数(補完の種類ごと。回数の少ない候補から削除する)
+    COMPACT_LINES = 100  # ログファイルの行数がこの値を超えたらまとめる
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, filepath):
+        """
+        filepath: 回数を保存するファイルのパス
+        """
+        self.filepath = filepath
+        self.lock = threading.Lock()  # 選択時の処理と、読み込み、まとめる処理のスレッドから使用する
+        self.counts = {}  # 補完の種類 -> {候補: 回数}
+        self.hot = {}  # 補完の種類 -> よく使う候補の(小文字化した文字列, 文字列)のリスト
+        self.log_lines = 0  # ログファイルの行数
+
+    # ----------------------------------------------------------------------------------------
+    def load(self):
+        """
+        回数のファイルとログファイルを読み込み、ログの内容をまとめる(別スレッドで実行する)
+        選択時の記録はログファイルにも書き込まれるため、読み込み中に選択された分が二重に数えられないように
+        lockを取得したまま読み込み、読み込んだ回数で置き換える
+        """
+        counts = {}
+        with self.lock:
+            for path, has_count in ((self.filepath, True), (self.filepath + self.LOG_EXT, False)):
+                try:
+                    with open(path, 'rb') as f:
+                        for line in f:
+                            fields = line.rstrip('\r\n').decode('utf-8', 'replace').split(u'\t')
+                            try:
+                                if has_count:
+                                    kind, count, word = fields[0], int(fields[1]), fields[2]  # 回数のファイル: 種類, 回数, 候補
+                                else:
+                                    kind, count, word = fields[0], 1, fields[1]  # ログファイル: 種類, 候補
+                            except (IndexError, ValueError):
+                                continue  # 書き込み途中の行などは無視する
+                            words = counts.setdefault(kind, {})
+                            words[word] = words.get(word, 0) + count
+                except (IOError, OSError):
+                    pass  # ファイルが存在しない
+            self.counts = counts
+            self.hot = {}
+            self.log_lines = 0
+            self.compact()
+
+    # ----------------------------------------------------------------------------------------
+    def record(self, kind, word):
+        """
+        選択した候補を記録する
+        kind: 補完の種類
+        word: 選択した候補
+        """
+        with self.lock:
+            words = self.counts.setdefault(kind, {})
+            words[word] = words.get(word, 0) + 1
+            self.hot.pop(kind, None)  # よく使う候補の一覧は次の検索時に作り直す
+            try:
+                with open(self.filepath + self.LOG_EXT, 'ab') as f:
+                    f.write(u'{}\t{}\n'.format(kind, word).encode('utf-8'))
+                self.log_lines += 1
+            except (IOError, OSError) as e:
+                console.write("Info: Could not write {} ({}).\n".format(os.path.basename(self.filepath + self.LOG_EXT), e))
+
+    # ----------------------------------------------------------------------------------------
+    def compact_if_needed(self):
+        """
+        ログファイルの行数が多い時はまとめる(別スレッドで実行する)
+        """
+        with self.lock:
+            if self.log_lines > self.COMPACT_LINES:
+                self.compact()
+
+    # ----------------------------------------------------------------------------------------
+    def compact(self):
+        """
+        回数をファイルに書き込み、ログファイルを空にする(lockを取得してから呼び出す)
+        """
+        lines = []
+        for kind, words in self.counts.items():
+            if len(words) > self.MAX_ENTRIES:
+                words = dict(heapq.nlargest(self.MAX_ENTRIES, words.items(), key=lambda item: item[1]))
+                self.counts[kind] = words
+            for word, count in words.items():
+                lines.append(u'{}\t{}\t{}\n'.format(kind, count, word))
+        try:
+            # 書き込み途中のファイルを読み込まないように、一時ファイルに書き込んでから置き換える
+            with open(self.filepath + '.tmp', 'wb') as f:
+                f.write(u''.join(lines).encode('utf-8'))
+            if os.path.exists(self.filepath):
+                os.remove(self.filepath)
+            os.rename(self.filepath + '.tmp', self.filepath)
+            with open(self.filepath + self.LOG_EXT, 'wb'):
+                pass  # まとめた後はログファイルを空にする
+            self.log_lines = 0
+        except (IOError, OSError) as e:
+            console.write("Info: Could not write {} ({}).\n".format(os.path.basename(self.filepath), e))
+
+    # ----------------------------------------------------------------------------------------
+    def hot_words(self, kind):
+        """
+        よく使う候補の(小文字化した文字列, 文字列)のリストを選択回数の多い順に返す
+        kind: 補完の種類
+        """
+        with self.lock:
+            hot = self.hot.get(kind)
+            if hot is None:
+                top = heapq.nlargest(self.HOT_SIZE, self.counts.get(kind, {}).items(), key=lambda item: item[1])
+                hot = self.hot[kind] = [(word.lower(), word) for word, count in top]
+            return hot
+
+
+
+class Profiler(object):
+    """
+    入力補完の各処理にかかった時間を記録するクラス(PROFILE_MODEがTrueの時だけ使用する)
+    処理ごとに対数間隔の区間で数えたヒストグラムを持つ(入力数によらずメモリ使用量は一定)
+    """
+    BOUNDS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]  # ヒストグラムの区間の上限(ミリ秒)
+    MAX_SLOW_LOG = 50  # 保持する遅い入力の記録の件数
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, slow_ms):
+        """
+        slow_ms: この時間(ミリ秒)以上かかった入力を記録する
+        """
+        self.slow_ms = slow_ms
+        self.lock = threading.Lock()  # 入力処理と検索処理のスレッドから記録する
+        self.phases = {}  # 処理名 -> [回数, 合計時間, 最大時間, ヒストグラム]
+        self.slow_log = deque(maxlen=self.MAX_SLOW_LOG)  # 遅い入力の(時刻, 単語, 補完の種類, 候補数, 処理時間)
+
+    # ----------------------------------------------------------------------------------------
+    def record(self, phase, sec):
+        """
+        処理時間を記録する
+        phase: 処理名
+        sec: 処理時間(秒)
+        """
+        ms = sec * 1000
+        i = bisect_left(self.BOUNDS, ms)
+        with self.lock:
+            stat = self.phases.get(phase)
+            if stat is None:
+                stat = self.phases[phase] = [0, 0.0, 0.0, [0] * (len(self.BOUNDS) + 1)]
+            stat[0] += 1
+            stat[1] += ms
+            stat[2] = max(stat[2], ms)
+            stat[3][i] += 1
+
+    # ----------------------------------------------------------------------------------------
+    def record_keystroke(self, word, mode, num, sec):
+        """
+        1文字入力の処理時間を記録し、遅い入力はコンソールに表示する
+        word: 入力中の単語
+        mode: 補完の種類
+        num: 候補数
+        sec: 文字入力から補完メニューの表示までの時間(秒)
+        """
+        self.record('keystroke', sec)
+        ms = sec * 1000
+        if ms >= self.slow_ms:
+            with self.lock:
+                self.slow_log.append((time.time(), word, mode, num, ms))
+            console.write("tagAutoComplete: slow keystroke {:.1f}ms word={!r} mode={} candidates={}\n".format(ms, word, mode, num))
+
+    # ----------------------------------------------------------------------------------------
+    def percentile(self, hist, count, p):
+        """
+        ヒストグラムからパーセンタイル値(その値を含む区間の上限)を返す
+        hist: ヒストグラム
+        count: 記録した回数
+        p: パーセント
+        """
+        n = 0
+        for i, c in enumerate(hist):
+            n += c
+            if n * 100 >= count * p:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else float('inf')
+        return float('inf')
+
+    # ----------------------------------------------------------------------------------------
+    def summary(self):
+        """
+        計測結果の表示用の文字列を返す
+        """
+        with self.lock:
+            phases = sorted([(name, stat[0], stat[1], stat[2], list(stat[3])) for name, stat in self.phases.items()])
+            slow_log = list(self.slow_log)
+        lines = ['{:<20} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}'.format('phase', 'count', 'avg ms', 'p50 <=', 'p95 <=', 'p99 <=', 'max ms')]
+        for name, count, total, max_ms, hist in phases:
+            lines.append('{:<20} {:>8} {:>9.2f} {:>9} {:>9} {:>9} {:>9.2f}'.format(
+                name, count, total / count, self.percentile(hist, count, 50), self.percentile(hist, count, 95),
+                self.percentile(hist, count, 99), max_ms))
+        lines.append('slow keystrokes (>= {}ms): {}'.format(self.slow_ms, len(slow_log)))
+        for t, word, mode, num, ms in slow_log:
+            lines.append('  {} {:>9.1f}ms {:<9} {:>3} {!r}'.format(time.strftime('%H:%M:%S', time.localtime(t)), ms, mode, num, word))
+        return '\n'.join(lines) + '\n'
 
 
 
@@ -282,62 +1966,283 @@ class TagAutoComplete(object):
         return cls._instance
 
     # ----------------------------------------------------------------------------------------
-    def __init__(self, csvfile):
+    def __init__(self, csvfiles, historyfile=None, loracachefile=None):
         if not hasattr(self, 'initialized'):
-            self.current_word = ""
-
+            self.current_word = ""  # メニューを表示した時の単語
+            self.active = True
+
+            # 入力された単語の補完候補は別スレッドで検索する
+            # 世代番号を使い、検索中に次の文字が入力された場合は古い検索結果を捨てる
+            self.request_cond = threading.Condition()
+            self.request = None  # 検索待ちの(世代番号, 単語)
+            self.generation = 0
+            self.trigger_menu = False  # 表示中のメニューがLora補完後のトリガーワードのメニュー
+            self.worker = None
+            self.profiler = Profiler(PROFILE_SLOW_MS) if PROFILE_MODE else None  # 処理時間の計測(無効時はNone)
+            # 再スキャンのスレッドを起こすイベント(読み込みのスレッドからも使用するため、スレッドを開始する前に作成する)
+            self.rescan_event = threading.Event()
+
+            # 選択回数の記録(無効時はNone)
+            self.history = UsageHistory(historyfile) if historyfile else None
+            if self.history is not None:
+                self.start_thread(self.history.load)
+
+            # 読み込みに時間がかかるため、それぞれ別スレッドで読み込む
+            # 読み込みが終わるまでは空の一覧を使用する(読み込み完了時に丸ごと入れ替える)
             self.wcm = WildcardManager()
             if WILDCARD_DIR:
-                if self.wcm.load_wildcards(WILDCARD_DIR):  # Wildcard一覧を指定したディレクトリから取得する
-                    console.write("Successfully loaded {} wildcards(dirs and files) from {}\n".format(self.wcm.get_wildcard_num(), WILDCARD_DIR))
+                self.start_thread(self.load_wildcard_list)
 
-            self.lom = LoraManager()
+            self.lom = LoraManager(loracachefile if LORA_TRIGGER_WORDS > 0 else None)
             if LORA_DIR:
-                if self.lom.load_loras(LORA_DIR):  # Lora一覧を指定したディレクトリから取得する
-                    console.write("Successfully loaded {} Loras from {}\n".format(self.lom.get_loras_num(), LORA_DIR))
+                self.start_thread(self.load_lora_list)
 
             self.tm = TagManager()
-            if self.tm.load_tagfile(csvfile):
-                console.write("Successfully loaded {} tags from {}\n".format(self.tm.get_tag_num(), os.path.basename(csvfile)))
+            self.csvfiles = csvfiles
+            self.start_thread(self.load_tag_list, csvfiles)
+
+            # タグファイルの更新を確認し、ワイルドカード、Loraのディレクトリを再スキャンする
+            # (定期的に、またはファイルの切り替え時、保存時に行なう)
+            if DIR_RESCAN_INTERVAL > 0:
+                self.start_thread(self.rescan_worker)
+
+    # ----------------------------------------------------------------------------------------
+    def start_thread(self, target, *args):
+        """
+        別スレッドで処理を実行する
+        target: 実行する関数
+        args: 関数の引数
+        """
+        th = threading.Thread(target=target, args=args)
+        th.daemon = True  # Notepad++の終了を妨げない
+        th.start()
+        return th
+
+    # ----------------------------------------------------------------------------------------
+    def load_wildcard_list(self):
+        """
+        Wildcard一覧を指定したディレクトリから取得する(別スレッドで実行する)
+        """
+        start = time.time()
+        if self.wcm.load_wildcards(WILDCARD_DIR):
+            console.write("Successfully loaded {} wildcards(dirs and files) from {} ({:.2f}s)\n".format(self.wcm.get_wildcard_num(), WILDCARD_DIR, time.time() - start))
+
+    # ----------------------------------------------------------------------------------------
+    def load_lora_list(self):
+        """
+        Lora一覧を指定したディレクトリから取得する(別スレッドで実行する)
+        """
+        start = time.time()
+        if self.lom.load_loras(LORA_DIR):
+            console.write("Successfully loaded {} Loras from {} ({:.2f}s)\n".format(self.lom.get_loras_num(), LORA_DIR, time.time() - start))
+            if LORA_TRIGGER_WORDS > 0:
+                # トリガーワードを先読みしておく(読み込み中にLoraが補完された時は、そのLoraだけを読み込む)
+                self.lom.load_trigger_cache()
+                self.lom.preload_triggers()
+
+    # ----------------------------------------------------------------------------------------
+    def rescan_worker(self):
+        """
+        タグファイルが更新されていたら読み込み直し、ワイルドカード、Loraのディレクトリを再スキャンする(別スレッドで実行する)
+        """
+        while True:
+            self.rescan_event.wait(DIR_RESCAN_INTERVAL)
+            self.rescan_event.clear()
+            if not self.active:
+                return
+            while self.active and self.tm.is_modified(self.csvfiles):  # 読み込み中に更新された場合はもう一度読み込む
+                start = time.time()
+                if self.tm.load_tagfile(self.csvfiles):
+                    console.write("Reloaded {} tags ({:.2f}s)\n".format(self.tm.get_tag_num(), time.time() - start))
+            if self.history is not None:
+                self.history.compact_if_needed()
+            if WILDCARD_DIR and self.wcm.rescan_wildcards():
+                console.write("Updated wildcards: {} wildcards(dirs and files)\n".format(self.wcm.get_wildcard_num()))
+            if LORA_DIR and self.lom.rescan_loras():
+                console.write("Updated Loras: {} Loras\n".format(self.lom.get_loras_num()))
+                if LORA_TRIGGER_WORDS > 0:
+                    self.lom.preload_triggers()  # 追加されたLoraのトリガーワードを読み込む
+
+    # ----------------------------------------------------------------------------------------
+    def load_tag_list(self, csvfiles):
+        """
+        タグ一覧を読み込み、読み込みが終わったら補完を有効化する(別スレッドで実行する)
+        csvfiles: タグファイルのパスのリスト(先頭のファイルほど優先する)
+        """
+        start = time.time()
+        if self.tm.load_tagfile(csvfiles):
+            filenames = ', '.join([os.path.basename(f) for f in csvfiles])
+            console.write("Successfully loaded {} tags from {} ({:.2f}s)\n".format(self.tm.get_tag_num(), filenames, time.time() - start))
+            # スクリプトの終了処理と同時に行なわないよう、ロックを取得してからコールバックを登録する
+            # (終了処理の後に登録すると、終了したスクリプトのコールバックが残ってしまう)
+            with self.request_cond:
+                if not self.active:
+                    return  # 読み込み中にスクリプトが終了された
+                if self.worker is None or not self.worker.is_alive():
+                    self.worker = self.start_thread(self.suggest_worker)
                 console.write("tagAutoComplete has been activated.\n")
                 # BUFFERACTIVATED イベントが発生するたびに on_buffer_activated を呼び出すよう登録
                 notepad.callback(self.on_buffer_activated, [NOTIFICATION.BUFFERACTIVATED])
-                self.on_buffer_activated(None)  # スクリプト起動時に現在開いているファイルに対してon_buffer_activatedを実行
+                notepad.callback(self.on_file_saved, [NOTIFICATION.FILESAVED])
+                self.on_buffer_activated(None)  # 現在開いているファイルに対してon_buffer_activatedを実行
 
     # ----------------------------------------------------------------------------------------
+    @classmethod
     def destroy_instance(cls):
-        if cls._instance:
-            # 登録してあるコールバックを解除する
-            notepad.clearCallbacks([NOTIFICATION.BUFFERACTIVATED])
-            editor.clearCallbacks([SCINTILLANOTIFICATION.CHARADDED, SCINTILLANOTIFICATION.AUTOCSELECTION])
+        instance = cls._instance
+        if instance:
+            # 読み込み中、検索中のスレッドにスクリプトの終了を知らせる
+            # (スレッドはそれぞれのインスタンスの active を確認するため、次に実行したスクリプトには影響しない)
+            with instance.request_cond:
+                instance.active = False
+                instance.tm.active = False
+                instance.lom.active = False
+                instance.request_cond.notify()
+
+                # 登録してあるコールバックを解除する
+                notepad.clearCallbacks([NOTIFICATION.BUFFERACTIVATED, NOTIFICATION.FILESAVED])
+                editor.clearCallbacks([SCINTILLANOTIFICATION.CHARADDED, SCINTILLANOTIFICATION.AUTOCSELECTION])
+            instance.rescan_event.set()
 
             console.write("tagAutoComplete has been deactivated.\n")
-            cls._instance = None
+            cls._instance = None  # 次に実行した時は新しいインスタンスを作成する
         return cls._instance
 
     # ----------------------------------------------------------------------------------------
     def on_char_added(self, args):
         """
-        文字入力時の補完処理
+        文字入力時の補完処理(検索は別スレッドに依頼する)
+        """
+        profiler = self.profiler
+        start = time.time() if profiler else None
+        word = editor.getWord(editor.getCurrentPos(), True)  # 現在の単語(Notepad++が単語として認識する文字列)を取得する
+        if profiler:
+            profiler.record('getWord', time.time() - start)
+        with self.request_cond:
+            # 検索待ちの依頼は最新の単語で上書きする(連続入力時は途中の単語を検索しない)
+            self.generation += 1
+            self.request = (self.generation, word, start)
+            self.request_cond.notify()
+
+    # ----------------------------------------------------------------------------------------
+    def suggest_worker(self):
+        """
+        補完候補を検索してメニューを表示する(別スレッドで実行する)
         """
-        self.current_word = editor.getWord(editor.getCurrentPos(), True)  # 現在の単語(Notepad++が単語として認識する文字列)を取得する
-        if len(self.current_word) < NUM_SHOW:
-            return  # 最低入力文字数に達してない
+        while True:
+            with self.request_cond:
+                while self.request is None and self.active:
+                    self.request_cond.wait(1.0)
+                if not self.active:
+                    return
+                generation, word, start = self.request
+                self.request = None
+
+            if len(word) < NUM_SHOW:
+                continue  # 最低入力文字数に達してない
+            profiler = self.profiler
+            if profiler is None:
+                self.show_suggestions(generation, word, self.get_suggestions(word))
+                continue
+
+            # 処理時間を計測する時は補完の種類ごとに記録する
+            mode = self.suggest_mode(word)
+            suggest_start = time.time()
+            suggestions = self.get_suggestions(word)
+            profiler.record(mode + '_suggest', time.time() - suggest_start)
+            self.show_suggestions(generation, word, suggestions)
+            profiler.record_keystroke(word, mode, len(suggestions), time.time() - start)
 
-        if self.current_word.startswith('____') and LORA_DIR:  # Lora補完
-            suggestions = self.lom.lora_suggest(self.current_word, MAX_SHOW_WORDS, OPT_WORD_IN)
-        elif self.current_word.startswith('__') and WILDCARD_DIR:  # ワイルドカード補完
-            suggestions = self.wcm.wildcard_suggest(self.current_word, MAX_SHOW_WORDS, OPT_WORD_IN)
+    # ----------------------------------------------------------------------------------------
+    def get_suggestions(self, word):
+        """
+        単語の補完候補一覧を返す
+        word: 入力中の単語
+        """
+        mode = self.suggest_mode(word)
+        hot_words = self.history.hot_words(mode) if self.history is not None else None  # よく使う候補
+        if mode == 'lora':  # Lora補完
+            return self.lom.lora_suggest(word, MAX_SHOW_WORDS, OPT_WORD_IN, hot_words)
+        elif mode == 'wildcard':  # ワイルドカード補完
+            return self.wcm.wildcard_suggest(word, MAX_SHOW_WORDS, OPT_WORD_IN, hot_words)
         else:  # タグ補完
-            suggestions = self.tm.tag_suggest(self.current_word, MAX_SHOW_WORDS, OPT_WORD_IN)
+            return self.tm.tag_suggest(word, MAX_SHOW_WORDS, OPT_WORD_IN, hot_words)
+
+    # ----------------------------------------------------------------------------------------
+    def suggest_mode(self, word):
+        """
+        補完の種類('lora', 'wildcard', 'tag')を返す
+        word: 入力中の単語
+        """
+        if word.startswith('____') and LORA_DIR:
+            return 'lora'
+        elif word.startswith('__') and WILDCARD_DIR:
+            return 'wildcard'
+        else:
+            return 'tag'
+
+    # ----------------------------------------------------------------------------------------
+    def show_suggestions(self, generation, word, suggestions):
+        """
+        補完候補のメニューを表示する(検索中に入力が進んでいる場合は表示しない)
+        generation: 検索を依頼した時の世代番号
+        word: 検索した単語
+        suggestions: 補完候補一覧
+        """
+        if generation != self.generation:
+            return  # 検索中に次の文字が入力された
+        current_pos = editor.getCurrentPos()
+        if editor.getWord(current_pos, True) != word:
+            return  # カーソル位置の単語が変わっている
+        if not suggestions:
+            return  # 候補が存在しない
+
+        self.current_word = word
+        self.trigger_menu = False
+        start = time.time() if self.profiler else None
+        self.show_menu(suggestions)
+        if self.profiler:
+            self.profiler.record('autoCShow', time.time() - start)
 
-        # 候補が存在する時にメニューを表示
-        if suggestions:
-            current_sep = editor.autoCGetSeparator() # Notepad++のセパレーター設定を取得する
+    # ----------------------------------------------------------------------------------------
+    def show_menu(self, items):
+        """
+        補完メニューを表示する
+        items: メニューに表示する文字列のリスト
+        """
+        current_sep = editor.autoCGetSeparator() # Notepad++のセパレーター設定を取得する
+        if current_sep != 44:
             editor.autoCSetSeparator(44) # セパレーター設定を','(Ascii:44)に変更する
-            editor.autoCShow(0, ",".join(suggestions)) # 部分一致に対応するため入力済みの文字数を0にしている
+        editor.autoCShow(0, ",".join(items)) # 部分一致に対応するため入力済みの文字数を0にしている
+        if current_sep != 44:
             editor.autoCSetSeparator(current_sep) # セパレーター設定を元に戻す
 
+    # ----------------------------------------------------------------------------------------
+    def show_trigger_words(self, s, pos):
+        """
+        Lora補完の後に、Loraのトリガーワードのメニューを表示する(別スレッドで実行する)
+        s: 補完したLoraの候補の文字列
+        pos: Loraを挿入した後のカーソル位置
+        """
+        words = self.lom.trigger_words(s)[:LORA_TRIGGER_WORDS]  # 読み込んでいない時はここで読み込む
+        if not words or not self.active:
+            return
+        if editor.getCurrentPos() != pos or editor.autoCActive():
+            return  # 読み込み中に入力が進んでいる
+        self.current_word = ''  # 入力済みの文字はない
+        self.trigger_menu = True
+        self.show_menu(words)
+
+    # ----------------------------------------------------------------------------------------
+    def dump_stats(self):
+        """
+        処理時間の計測結果をコンソールに表示する(tagAutoComplete_stats.py から呼び出す)
+        """
+        if self.profiler is None:
+            console.write("tagAutoComplete: PROFILE_MODE is disabled. Set PROFILE_MODE = True in tagAutoComplete.py and restart the script.\n")
+            return
+        console.write(self.profiler.summary())
+
     # ----------------------------------------------------------------------------------------
     def on_buffer_activated(self, args):
         """
@@ -354,6 +2259,14 @@ class TagAutoComplete(object):
             editor.callback(self.on_char_added, [SCINTILLANOTIFICATION.CHARADDED])
             editor.callback(self.on_autocompletion_selected, [SCINTILLANOTIFICATION.AUTOCSELECTION])
             console.write("AutoComplete ENABLED for file: {}\n".format(current_filename))
+            self.rescan_event.set()  # ワイルドカード、Loraの一覧を更新する
+
+    # ----------------------------------------------------------------------------------------
+    def on_file_saved(self, args):
+        """
+        ファイルが保存された時の処理(タグファイル、ワイルドカードを編集した時にすぐ反映する)
+        """
+        self.rescan_event.set()
 
     # ----------------------------------------------------------------------------------------
     def process_string(self, s):
@@ -388,13 +2301,22 @@ class TagAutoComplete(object):
         オートコンプリート項目選択後の加工処理
         """
 
+        profiler = self.profiler
+        start = time.time() if profiler else None
         selected_text = args['text']
+        trigger_menu = self.trigger_menu  # トリガーワードのメニューから選択された
+        self.trigger_menu = False
         max_len = editor.getLength()
         current_pos = editor.getCurrentPos()
         replace_start_pos = current_pos - len(self.current_word) - len(selected_text) # テキスト置換の開始位置(入力済み文字数 + メニューから選択した文字数 だけ戻る)
         replace_end_pos = current_pos
 
         output_text = self.process_string(selected_text) # 文字列を加工する
+        if self.history is not None:
+            self.history.record(self.suggest_mode(self.current_word), selected_text.decode('utf-8'))  # 選択した回数を記録する
+        if profiler:
+            process_end = time.time()
+            profiler.record('select_process', process_end - start)
 
         # TRIM_SEPARATER_SPACEがTrueの時にタグと区切り文字の間の空白を削除する
         if TRIM_SEPARATER_SPACE is True:
@@ -416,6 +2338,14 @@ class TagAutoComplete(object):
             add_sep = WILDCARD_ADD_SEPARATER
         if add_sep:
             output_text += TEXT_SEPARATER  # 区切り文字を追加
+        if trigger_menu and replace_start_pos > 0:
+            prev_char = editor.getTextRange(replace_start_pos - 1, replace_start_pos)
+            if not prev_char.isspace() and prev_char not in TEXT_SEPARATER:
+                output_text = TEXT_SEPARATER + output_text  # Loraとトリガーワードの間に区切り文字を入れる
+
+        if profiler:
+            replace_start = time.time()
+            profiler.record('select_separator', replace_start - process_end)
 
         # 選択された元のテキストを、加工後のテキストで置き換える
         editor.setTargetRange(replace_start_pos, replace_end_pos)
@@ -424,6 +2354,15 @@ class TagAutoComplete(object):
         # カーソル位置を計算して移動
         editor.gotoPos(replace_start_pos + len(output_text))
 
+        if profiler:
+            end = time.time()
+            profiler.record('select_replace', end - replace_start)
+            profiler.record('select', end - start)
+
+        # Lora補完の後はトリガーワードのメニューを表示する(ファイルの読み込みで入力を止めないよう別スレッドで行なう)
+        if self.current_word.startswith('____') and LORA_DIR and LORA_TRIGGER_WORDS > 0 and not trigger_menu:
+            self.start_thread(self.show_trigger_words, selected_text.decode('utf-8'), replace_start_pos + len(output_text))
+
 
 
 # ----------------------------------------------------------------------------------------
@@ -437,5 +2376,8 @@ if __name__ == '__main__':
         globals()[GLOBAL_TAC_INSTANCE] = _tag_aut_comp.destroy_instance()
     else:
         script_dir = os.path.dirname(__file__.decode('utf-8')) # パスが非ASCII文字を含む場合に備える
-        csvfilepath = os.path.join(script_dir, TAG_FILENAME)
-        globals()[GLOBAL_TAC_INSTANCE] = TagAutoComplete(csvfilepath)
+        tag_filenames = TAG_FILENAME if isinstance(TAG_FILENAME, (list, tuple)) else [TAG_FILENAME]  # 複数のファイルを指定できる
+        csvfilepaths = [os.path.join(script_dir, filename) for filename in tag_filenames]
+        historyfilepath = os.path.join(script_dir, HISTORY_FILENAME) if USE_HISTORY else None
+        loracachefilepath = os.path.join(script_dir, 'tagAutoComplete_lora.cache')
+        globals()[GLOBAL_TAC_INSTANCE] = TagAutoComplete(csvfilepaths, historyfilepath, loracachefilepath)
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+# tagAutoComplete.py の処理時間の計測結果をコンソールに表示するスクリプト
+#
+# 使い方
+#   tagAutoComplete.py の PROFILE_MODE を True にしてから tagAutoComplete.py を実行してください
+#   しばらく入力した後でこのスクリプトを実行すると、[プラグイン]->[Python Script]->[Show Console] に計測結果を表示します
+#     - 処理ごとの回数、平均、p50/p95/p99(ヒストグラムの区間の上限)、最大の処理時間(ミリ秒)
+#     - PROFILE_SLOW_MS 以上かかった最近の入力の一覧
+#   [プラグイン]->[Python Script]->[Configuration] でメニューに追加するとすぐに実行できます
+
+from Npp import console
+
+GLOBAL_TAC_INSTANCE = 'TAG_AUTO_COMPLETE_INSTANCE'
+
+if GLOBAL_TAC_INSTANCE in globals() and globals()[GLOBAL_TAC_INSTANCE]:
+    globals()[GLOBAL_TAC_INSTANCE].dump_stats()
+else:
+    console.write("tagAutoComplete is not running.\n")